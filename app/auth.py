@@ -1,7 +1,7 @@
 from sanic import Blueprint, response
 from sqlalchemy.exc import IntegrityError
 from app.models import User
-from app.utils import session_scope, get_user_by_email
+from app.db import async_session_scope, get_user_by_email_async
 
 auth_bp = Blueprint('auth')
 
@@ -14,14 +14,15 @@ async def signup(request):
     if not email.endswith('@moraeglobal.com'):
         return response.json({'error': 'Email domain must be @moraeglobal.com'}, status=400)
 
-    with session_scope() as session:
+    async with async_session_scope() as session:
         user = User(fullname=fullname, email=email)
         user.set_password(password)
 
         try:
             session.add(user)
-            session.commit()
+            await session.commit()
         except IntegrityError:
+            await session.rollback()
             return response.json({'error': 'Email already registered'}, status=400)
 
     return response.json({'message': 'User registered successfully'})
@@ -31,15 +32,14 @@ async def login(request):
     email = request.json.get('email')
     password = request.json.get('password')
 
-    with session_scope() as session:
-        user = get_user_by_email(session, email)
+    async with async_session_scope() as session:
+        user = await get_user_by_email_async(session, email)
 
         if user is None or not user.check_password(password):
             return response.json({'error': 'Invalid credentials'}, status=401)
 
-        # Reload the user into the session to ensure it is attached
-        session.add(user)
-        session.refresh(user)
+        # Shared by every web worker through the Redis session store
+        request.ctx.session['user_id'] = user.id
 
         # Convert the user.id to a string when setting the cookie
         resp = response.json({'message': 'Logged in successfully'})
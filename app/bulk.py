@@ -0,0 +1,209 @@
+import json
+import time
+import uuid
+import logging
+from app.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# A bulk run OCRs every pending file of a project through one page-level work
+# queue. Batches from all files share the queue and at most max_in_flight of
+# them are handed to Celery at a time, so workers move straight from one
+# file's last batch to the next file's first. Each file is merged as soon as
+# its own batches are done (each file is a job, see app.jobs), and the run keeps
+# one aggregated status. The run knows its file count from the start, so files
+# finishing while later ones are still being planned cannot close it early.
+#
+# Batches and files are counted once per run: the run keeps the last state
+# ('ok' or 'failed') of every batch and file, so a redelivered merge or a
+# resumed file only moves a count when its outcome turns from failed to ok.
+RUN_KEY = "ocr:run:{run_id}"
+RUN_QUEUE_KEY = "ocr:run:{run_id}:queue"
+RUN_BATCHES_KEY = "ocr:run:{run_id}:batches"
+RUN_FILES_KEY = "ocr:run:{run_id}:files"
+PROJECT_RUN_KEY = "ocr:project_run:{project_id}"
+RUN_TTL = 24 * 3600
+
+# Atomically move up to (max_in_flight - in_flight) work items off the queue
+CLAIM_SCRIPT = """
+local max_in_flight = tonumber(redis.call('HGET', KEYS[1], 'max_in_flight') or '0')
+local in_flight = tonumber(redis.call('HGET', KEYS[1], 'in_flight') or '0')
+local items = {}
+while in_flight < max_in_flight do
+    local item = redis.call('LPOP', KEYS[2])
+    if not item then break end
+    in_flight = in_flight + 1
+    table.insert(items, item)
+end
+redis.call('HSET', KEYS[1], 'in_flight', in_flight)
+return items
+"""
+
+# KEYS[1] = run, KEYS[2] = batch states, ARGV[1] = job|batch key, ARGV[2] = 'ok' or 'failed',
+# ARGV[3] = pages in the batch, ARGV[4] = now, ARGV[5] = TTL
+RECORD_BATCH_SCRIPT = """
+redis.call('HINCRBY', KEYS[1], 'in_flight', -1)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[4])
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous == 'ok' then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+if not previous then redis.call('HINCRBY', KEYS[1], 'batches_done', 1) end
+if ARGV[2] == 'ok' then redis.call('HINCRBY', KEYS[1], 'pages_done', ARGV[3]) end
+return 1
+"""
+
+# KEYS[1] = run, KEYS[2] = file states, ARGV[1] = file id, ARGV[2] = 'ok' or 'failed', ARGV[3] = now, ARGV[4] = TTL
+RECORD_FILE_SCRIPT = """
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous == ARGV[2] or previous == 'ok' then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[4])
+if previous == 'failed' then redis.call('HINCRBY', KEYS[1], 'files_failed', -1) end
+redis.call('HINCRBY', KEYS[1], ARGV[2] == 'ok' and 'files_done' or 'files_failed', 1)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[3])
+return 1
+"""
+
+
+def create_run(project_id, user_id, ocr_option, max_in_flight, files_total):
+    """Start a bulk run over files_total files and make it the project's current run."""
+    run_id = uuid.uuid4().hex
+    now = time.time()
+    redis_client = get_redis()
+    pipeline = redis_client.pipeline()
+    pipeline.hset(RUN_KEY.format(run_id=run_id), mapping={
+        "project_id": project_id,
+        "user_id": user_id,
+        "ocr_option": ocr_option,
+        "state": "Processing",
+        "max_in_flight": max_in_flight,
+        "in_flight": 0,
+        "files_total": files_total,
+        "files_done": 0,
+        "files_failed": 0,
+        "pages_total": 0,
+        "pages_done": 0,
+        "batches_total": 0,
+        "batches_done": 0,
+        "started_at": now,
+        "updated_at": now,
+    })
+    pipeline.expire(RUN_KEY.format(run_id=run_id), RUN_TTL)
+    pipeline.set(PROJECT_RUN_KEY.format(project_id=project_id), run_id, ex=RUN_TTL)
+    pipeline.execute()
+    return run_id
+
+
+def get_run(run_id):
+    raw = get_redis().hgetall(RUN_KEY.format(run_id=run_id))
+    return {key.decode(): value.decode() for key, value in raw.items()}
+
+
+def add_file(run_id, file_id, job_id, batches):
+    """Queue a file's page batches ((start, end, path) tuples) behind those already in the run."""
+    pages = sum(end - start + 1 for start, end, _ in batches)
+    run_key = RUN_KEY.format(run_id=run_id)
+    queue_key = RUN_QUEUE_KEY.format(run_id=run_id)
+
+    pipeline = get_redis().pipeline()
+    pipeline.rpush(queue_key, *[
+        json.dumps({"file_id": file_id, "job_id": job_id, "start_page": start, "end_page": end, "path": path})
+        for start, end, path in batches
+    ])
+    pipeline.expire(queue_key, RUN_TTL)
+    pipeline.hincrby(run_key, "pages_total", pages)
+    pipeline.hincrby(run_key, "batches_total", len(batches))
+    pipeline.execute()
+
+
+def add_failed_file(run_id, file_id):
+    """Count a file that could not be queued (e.g. it failed to burst)."""
+    record_file_state(run_id, file_id, failed=True)
+
+
+def claim_items(run_id):
+    """Take as many work items as the run's in-flight bound allows."""
+    items = get_redis().eval(CLAIM_SCRIPT, 2, RUN_KEY.format(run_id=run_id), RUN_QUEUE_KEY.format(run_id=run_id))
+    return [json.loads(item) for item in items]
+
+
+def record_batch(run_id, job_id, result):
+    """Free the batch's in-flight slot and count it towards the run, once per batch."""
+    get_redis().eval(
+        RECORD_BATCH_SCRIPT, 2, RUN_KEY.format(run_id=run_id), RUN_BATCHES_KEY.format(run_id=run_id),
+        f"{job_id}|{result['start_page']}-{result['end_page']}", 'failed' if 'error' in result else 'ok',
+        result['end_page'] - result['start_page'] + 1, time.time(), RUN_TTL,
+    )
+
+
+def queued_items(run_id):
+    """Work items still waiting in the run's queue (not yet handed to Celery)."""
+    return [json.loads(item) for item in get_redis().lrange(RUN_QUEUE_KEY.format(run_id=run_id), 0, -1)]
+
+
+def reserve_slots(run_id, count):
+    """Take in-flight slots for work items dispatched outside claim_items (e.g. when resuming a job)."""
+    if count:
+        get_redis().hincrby(RUN_KEY.format(run_id=run_id), "in_flight", count)
+
+
+def record_file_state(run_id, file_id, failed):
+    get_redis().eval(
+        RECORD_FILE_SCRIPT, 2, RUN_KEY.format(run_id=run_id), RUN_FILES_KEY.format(run_id=run_id),
+        file_id, 'failed' if failed else 'ok', time.time(), RUN_TTL,
+    )
+
+
+def record_file_done(run_id, file_id, failed):
+    """Count a merged file, once however often its merge runs, and close the run once every file is in."""
+    record_file_state(run_id, file_id, failed)
+    close_run_if_finished(run_id)
+
+
+def close_run_if_finished(run_id):
+    run = get_run(run_id)
+    if run and int(run["files_done"]) + int(run["files_failed"]) >= int(run["files_total"]):
+        state = "Processed" if int(run["files_failed"]) == 0 else "Completed with failures"
+        get_redis().hset(RUN_KEY.format(run_id=run_id), mapping={"state": state, "updated_at": time.time()})
+
+
+def summarize_run(run_id, run):
+    if not run:
+        return None
+    started_at = float(run["started_at"])
+    updated_at = float(run["updated_at"])
+    finished = run["state"] != "Processing"
+    elapsed = (updated_at if finished else time.time()) - started_at
+    pages_done = int(run["pages_done"])
+    pages_total = int(run["pages_total"])
+    pages_per_second = pages_done / elapsed if elapsed > 0 else 0.0
+    return {
+        "run_id": run_id,
+        "project_id": int(run["project_id"]),
+        "state": run["state"],
+        "files_total": int(run["files_total"]),
+        "files_done": int(run["files_done"]),
+        "files_failed": int(run["files_failed"]),
+        "pages_total": pages_total,
+        "pages_done": pages_done,
+        "batches_total": int(run["batches_total"]),
+        "batches_done": int(run["batches_done"]),
+        "batches_in_flight": int(run["in_flight"]),
+        "percent": round(100.0 * pages_done / pages_total, 1) if pages_total else 0.0,
+        "elapsed_seconds": round(max(elapsed, 0.0), 1),
+        "pages_per_second": round(pages_per_second, 3),
+        "eta_seconds": round((pages_total - pages_done) / pages_per_second, 1)
+        if not finished and pages_per_second > 0 else None,
+    }
+
+
+async def get_project_run_status_async(project_id):
+    """Status of the project's most recent bulk run, or None if it has none."""
+    redis_client = get_async_redis()
+    run_id = await redis_client.get(PROJECT_RUN_KEY.format(project_id=project_id))
+    if run_id is None:
+        return None
+    run_id = run_id.decode()
+    raw = await redis_client.hgetall(RUN_KEY.format(run_id=run_id))
+    return summarize_run(run_id, {key.decode(): value.decode() for key, value in raw.items()})
@@ -0,0 +1,35 @@
+import os
+from celery import Celery
+from config import CeleryConfig
+from app.scheduling import INTERACTIVE_QUEUE, BULK_QUEUE, BROKER_TRANSPORT_OPTIONS
+
+# The Celery app on its own, without the tasks. The web tier only needs it to
+# publish tasks by name, so it never imports app.tasks and the OCR stack
+# (fitz, pikepdf, PyPDF2, ocrmypdf) behind it.
+celery = Celery('ocr_tasks')
+celery.config_from_object(CeleryConfig)
+
+# Control tasks are tiny and latency sensitive; page batches are routed per job by schedule_batches
+celery.conf.task_routes = {
+    'app.tasks.ocr_pdf_file': {'queue': INTERACTIVE_QUEUE},
+    'app.tasks.merge_ocr_batches': {'queue': INTERACTIVE_QUEUE},
+    'app.tasks.finish_bulk_file': {'queue': INTERACTIVE_QUEUE},
+    'app.tasks.ocr_pdf_folder': {'queue': BULK_QUEUE},
+    'app.tasks.index_file_text': {'queue': BULK_QUEUE},
+    'app.tasks.resume_file_ocr': {'queue': INTERACTIVE_QUEUE},
+    'app.tasks.reap_stalled_jobs': {'queue': INTERACTIVE_QUEUE},
+}
+# Includes the visibility timeout after which unacknowledged batches are redelivered
+celery.conf.broker_transport_options = {
+    **(celery.conf.broker_transport_options or {}),
+    **BROKER_TRANSPORT_OPTIONS,
+}
+# Stalled-job reaper, run by the worker's embedded beat (celery worker -B)
+celery.conf.beat_schedule = {
+    'reap-stalled-ocr-jobs': {
+        'task': 'app.tasks.reap_stalled_jobs',
+        'schedule': float(os.getenv('OCR_REAPER_INTERVAL', '300')),
+    },
+}
+# Reserve one task at a time so queue order and priorities decide what runs next
+celery.conf.worker_prefetch_multiplier = 1
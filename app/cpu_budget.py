@@ -0,0 +1,110 @@
+import os
+import time
+import uuid
+import socket
+import logging
+import threading
+from contextlib import contextmanager
+from app.redis_client import get_redis
+
+logger = logging.getLogger(__name__)
+
+# Cores are shared between every OCR batch running on this host. Each batch
+# claims a share when its engine starts and hands it back when it finishes, so
+# a lone batch gets the whole machine while a full worker pool splits it.
+# Every claim is its own entry with a deadline that the holder pushes forward
+# every CPU_BUDGET_HEARTBEAT seconds for as long as it runs: a worker killed
+# before it releases (OOM, SIGKILL) stops renewing, only holds its cores for
+# CPU_BUDGET_TTL more seconds, and the next claim drops it instead of the host
+# budget shrinking for good. Long batches keep their share however long they take.
+CPU_BUDGET_KEY = f"ocr:cpu_budget:{socket.gethostname()}"
+CPU_BUDGET_TTL = int(os.getenv('OCR_CPU_BUDGET_TTL', '300'))
+CPU_BUDGET_HEARTBEAT = max(1, CPU_BUDGET_TTL // 3)
+
+# KEYS[1] = zset of claim ids scored by deadline, KEYS[2] = hash of claim id -> cores
+# ARGV[1] = host cores, ARGV[2] = most cores the batch can use, ARGV[3] = TTL,
+# ARGV[4] = now, ARGV[5] = claim id
+CLAIM_SCRIPT = """
+local expired = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[4])
+for _, claim_id in ipairs(expired) do
+    redis.call('HDEL', KEYS[2], claim_id)
+end
+redis.call('ZREMRANGEBYSCORE', KEYS[1], '-inf', ARGV[4])
+local used = 0
+for _, cores in ipairs(redis.call('HVALS', KEYS[2])) do
+    used = used + tonumber(cores)
+end
+local in_flight = redis.call('ZCARD', KEYS[1]) + 1
+local total = tonumber(ARGV[1])
+local fair = math.ceil(total / in_flight)
+local share = math.max(1, math.min(total - used, fair, tonumber(ARGV[2])))
+redis.call('ZADD', KEYS[1], tonumber(ARGV[4]) + tonumber(ARGV[3]), ARGV[5])
+redis.call('HSET', KEYS[2], ARGV[5], share)
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+return share
+"""
+
+# KEYS as above; ARGV[1] = new deadline, ARGV[2] = TTL, ARGV[3] = claim id.
+# A claim that already expired and was dropped is not brought back.
+RENEW_SCRIPT = """
+if not redis.call('ZSCORE', KEYS[1], ARGV[3]) then
+    return 0
+end
+redis.call('ZADD', KEYS[1], ARGV[1], ARGV[3])
+redis.call('EXPIRE', KEYS[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[2])
+return 1
+"""
+
+RELEASE_SCRIPT = """
+redis.call('ZREM', KEYS[1], ARGV[1])
+redis.call('HDEL', KEYS[2], ARGV[1])
+return 1
+"""
+
+
+@contextmanager
+def claim_cpus(max_cpus, total_cpus=None):
+    """
+    Claim a share of this host's cores for one engine invocation, capped at
+    max_cpus (e.g. the batch's page count). Yields the number of cores to use,
+    or None when Redis is unreachable and the caller should use a static share.
+    """
+    total_cpus = total_cpus or os.cpu_count() or 1
+    keys = [f"{CPU_BUDGET_KEY}:claims", f"{CPU_BUDGET_KEY}:shares"]
+    claim_id = uuid.uuid4().hex
+    try:
+        share = int(get_redis().eval(CLAIM_SCRIPT, 2, *keys, total_cpus, max(1, max_cpus), CPU_BUDGET_TTL,
+                                     time.time(), claim_id))
+    except Exception as e:
+        logger.error(f"Failed to claim CPU budget, falling back to a static share. Error: {e}")
+        yield None
+        return
+
+    logger.debug(f"Claimed {share} of {total_cpus} cores for an OCR batch")
+    released = threading.Event()
+    heartbeat = threading.Thread(target=renew_claim, args=(keys, claim_id, released),
+                                 name=f"cpu-claim-{claim_id[:8]}", daemon=True)
+    heartbeat.start()
+    try:
+        yield share
+    finally:
+        released.set()
+        heartbeat.join()
+        try:
+            get_redis().eval(RELEASE_SCRIPT, 2, *keys, claim_id)
+        except Exception as e:
+            logger.error(f"Failed to release CPU budget of {share} cores. Error: {e}")
+
+
+def renew_claim(keys, claim_id, released):
+    """Push the claim's deadline CPU_BUDGET_TTL ahead every heartbeat until released is set."""
+    while not released.wait(CPU_BUDGET_HEARTBEAT):
+        try:
+            if not int(get_redis().eval(RENEW_SCRIPT, 2, *keys, time.time() + CPU_BUDGET_TTL,
+                                        CPU_BUDGET_TTL, claim_id)):
+                logger.warning(f"CPU budget claim {claim_id} expired before it was renewed")
+                return
+        except Exception as e:
+            logger.error(f"Failed to renew CPU budget claim {claim_id}. Error: {e}")
@@ -0,0 +1,51 @@
+import os
+from contextlib import asynccontextmanager
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from config import Config
+from app.models import User
+
+# Async engine for the Sanic handlers, so a slow query never blocks the event
+# loop. The Celery workers keep using the synchronous session_scope in utils.
+DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '10'))
+DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '20'))
+DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '10'))
+DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+
+
+def async_database_uri(uri):
+    """Point a postgresql:// (or postgresql+psycopg2://) URI at the asyncpg driver."""
+    scheme, _, rest = uri.partition('://')
+    if scheme in ('postgres', 'postgresql') or scheme.startswith('postgresql+'):
+        return f"postgresql+asyncpg://{rest}"
+    return uri
+
+
+async_engine = create_async_engine(
+    async_database_uri(Config.SQLALCHEMY_DATABASE_URI),
+    pool_size=DB_POOL_SIZE,
+    max_overflow=DB_MAX_OVERFLOW,
+    pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE,
+    pool_pre_ping=True,
+)
+AsyncSession = async_sessionmaker(bind=async_engine, expire_on_commit=False)
+
+
+@asynccontextmanager
+async def async_session_scope():
+    """Provide a transactional scope around a series of async operations."""
+    session = AsyncSession()
+    try:
+        yield session
+        await session.commit()
+    except Exception:
+        await session.rollback()
+        raise
+    finally:
+        await session.close()
+
+
+async def get_user_by_email_async(session, email):
+    result = await session.execute(select(User).filter_by(email=email))
+    return result.scalars().first()
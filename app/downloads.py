@@ -0,0 +1,125 @@
+import os
+from typing import NamedTuple
+from email.utils import formatdate, parsedate_to_datetime
+from sanic import response
+from aiofiles import os as async_os
+
+# Finished outputs can be several GB, so downloads honour Range/If-Range (an
+# interrupted download resumes where it stopped) and ETag/Last-Modified
+# conditional requests. When DOWNLOAD_ACCEL_PREFIX is set, a front proxy
+# (nginx) serves the bytes with sendfile: the handler only answers with an
+# X-Accel-Redirect to <prefix><path relative to DOWNLOAD_ACCEL_ROOT> and the
+# Sanic worker is free again. Otherwise Sanic streams the file itself in
+# chunks sized to the transfer.
+DOWNLOAD_ACCEL_PREFIX = os.getenv('DOWNLOAD_ACCEL_PREFIX')
+DOWNLOAD_ACCEL_ROOT = os.path.abspath(os.getenv('DOWNLOAD_ACCEL_ROOT', '.'))
+MIN_CHUNK_SIZE = 64 * 1024
+MAX_CHUNK_SIZE = 1024 * 1024
+
+
+class ByteRange(NamedTuple):
+    """Inclusive byte range in the shape sanic's file_stream expects for partial content."""
+    start: int
+    end: int
+    size: int
+    total: int
+
+
+def chunk_size_for(length):
+    """Aim for ~64 reads per transfer, between 64 KiB and 1 MiB."""
+    return max(MIN_CHUNK_SIZE, min(MAX_CHUNK_SIZE, length // 64 // MIN_CHUNK_SIZE * MIN_CHUNK_SIZE))
+
+
+def file_etag(file_stat):
+    return f'"{file_stat.st_ino:x}-{file_stat.st_size:x}-{file_stat.st_mtime_ns:x}"'
+
+
+def parse_http_date(value):
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_range(value, total):
+    """
+    Parse a single-range "bytes=" Range header. Returns a ByteRange, None when
+    the header should be ignored (absent, malformed or multi-range), or False
+    when the range cannot be satisfied.
+    """
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    first, _, last = value[len('bytes='):].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            if last and int(last) < start:
+                return None
+            end = min(int(last), total - 1) if last else total - 1
+        else:
+            # Suffix range: the last N bytes
+            start = max(total - int(last), 0)
+            end = total - 1
+    except ValueError:
+        return None
+    if start >= total:
+        return False
+    return ByteRange(start, end, end - start + 1, total)
+
+
+def not_modified(request, etag, mtime):
+    if_none_match = request.headers.get('If-None-Match')
+    if if_none_match:
+        tags = [tag.strip() for tag in if_none_match.split(',')]
+        return '*' in tags or etag in tags or f"W/{etag}" in tags
+    since = parse_http_date(request.headers.get('If-Modified-Since'))
+    return since is not None and int(mtime) <= since
+
+
+def range_applies(request, etag, last_modified):
+    """If-Range: only honour Range when the client's copy is still the current file."""
+    if_range = request.headers.get('If-Range')
+    if not if_range:
+        return True
+    if if_range.startswith(('"', 'W/')):
+        return if_range == etag
+    return if_range == last_modified
+
+
+async def serve_file(request, file_path, filename, content_type='application/pdf'):
+    """Send file_path as an attachment with conditional and Range request support."""
+    file_stat = await async_os.stat(file_path)
+    etag = file_etag(file_stat)
+    last_modified = formatdate(file_stat.st_mtime, usegmt=True)
+    headers = {
+        'Content-Disposition': f'attachment; filename="{filename}"',
+        'ETag': etag,
+        'Last-Modified': last_modified,
+        'Accept-Ranges': 'bytes',
+    }
+
+    if not_modified(request, etag, file_stat.st_mtime):
+        return response.empty(status=304, headers=headers)
+
+    if DOWNLOAD_ACCEL_PREFIX:
+        relative_path = os.path.relpath(os.path.abspath(file_path), DOWNLOAD_ACCEL_ROOT)
+        if not relative_path.startswith('..'):
+            # The proxy handles Range and conditional headers itself from here on
+            headers['X-Accel-Redirect'] = DOWNLOAD_ACCEL_PREFIX.rstrip('/') + '/' + relative_path
+            return response.empty(status=200, headers={**headers, 'Content-Type': content_type})
+
+    byte_range = None
+    if range_applies(request, etag, last_modified):
+        byte_range = parse_range(request.headers.get('Range'), file_stat.st_size)
+        if byte_range is False:
+            return response.empty(status=416, headers={**headers, 'Content-Range': f"bytes */{file_stat.st_size}"})
+
+    length = byte_range.size if byte_range else file_stat.st_size
+    headers['Content-Length'] = str(length)
+    return await response.file_stream(
+        file_path,
+        chunk_size=chunk_size_for(length),
+        mime_type=content_type,
+        headers=headers,
+        _range=byte_range,
+    )
@@ -0,0 +1,195 @@
+import json
+import time
+import resource
+import logging
+from contextlib import contextmanager
+from app.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Every pipeline stage runs inside a span that measures wall time, CPU time of
+# this process and of its waited-for children (ocrmypdf, tesseract, magick),
+# the children's peak RSS and the bytes this process read and wrote. A span is
+# written twice: appended to the job's timing record (tagged with file_id and
+# batch) and folded into per-stage counters that /metrics serves in the
+# Prometheus text format. Queue wait is recorded as its own "queue_wait" span
+# next to each batch's "ocr_batch" span.
+STAGE_METRICS_KEY = "ocr:metrics:stages"
+JOB_TIMING_KEY = "ocr:timing:{file_id}"
+TIMING_TTL = 24 * 3600
+MAX_SPANS_PER_JOB = 5000
+# Histogram buckets for stage wall time, in seconds
+WALL_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1800)
+
+
+def io_counters():
+    """(bytes_read, bytes_written) by this process, from /proc or, failing that, block counts."""
+    try:
+        with open('/proc/self/io') as io_file:
+            fields = dict(line.split(': ', 1) for line in io_file.read().splitlines())
+        return int(fields['read_bytes']), int(fields['write_bytes'])
+    except (OSError, KeyError, ValueError):
+        usage = resource.getrusage(resource.RUSAGE_SELF)
+        return usage.ru_inblock * 512, usage.ru_oublock * 512
+
+
+def record_span(record):
+    """Append a finished span to its job's timing record and to the stage metrics."""
+    stage = record["stage"]
+    try:
+        pipeline = get_redis().pipeline()
+        if record.get("file_id") is not None:
+            key = JOB_TIMING_KEY.format(file_id=record["file_id"])
+            pipeline.rpush(key, json.dumps(record, separators=(',', ':')))
+            pipeline.ltrim(key, -MAX_SPANS_PER_JOB, -1)
+            pipeline.expire(key, TIMING_TTL)
+        pipeline.hincrby(STAGE_METRICS_KEY, f"{stage}|count", 1)
+        if record.get("status") == "error":
+            pipeline.hincrby(STAGE_METRICS_KEY, f"{stage}|errors", 1)
+        for bucket in WALL_BUCKETS:
+            if record["wall_s"] <= bucket:
+                pipeline.hincrby(STAGE_METRICS_KEY, f"{stage}|bucket|{bucket}", 1)
+        for field in ("wall_s", "cpu_s", "children_cpu_s", "bytes_read", "bytes_written"):
+            if field in record:
+                pipeline.hincrbyfloat(STAGE_METRICS_KEY, f"{stage}|{field}", record[field])
+        pipeline.execute()
+    except Exception as e:
+        logger.error(f"Failed to record the {stage} span for file_id: {record.get('file_id')}: {e}")
+
+
+@contextmanager
+def span(stage, file_id=None, batch=None):
+    """Measure the enclosed block as one span of stage for file_id and batch (e.g. "1-25")."""
+    started_at = time.time()
+    wall_started = time.perf_counter()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    read_before, written_before = io_counters()
+    status = "ok"
+    try:
+        yield
+    except BaseException:
+        status = "error"
+        raise
+    finally:
+        wall = time.perf_counter() - wall_started
+        self_after = resource.getrusage(resource.RUSAGE_SELF)
+        children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+        read_after, written_after = io_counters()
+        record_span({
+            "stage": stage,
+            "file_id": file_id,
+            "batch": batch,
+            "status": status,
+            "started_at": round(started_at, 3),
+            "wall_s": round(wall, 4),
+            "cpu_s": round((self_after.ru_utime + self_after.ru_stime)
+                           - (self_before.ru_utime + self_before.ru_stime), 4),
+            "children_cpu_s": round((children_after.ru_utime + children_after.ru_stime)
+                                    - (children_before.ru_utime + children_before.ru_stime), 4),
+            # ru_maxrss of children is the largest child this process has waited for so far
+            "children_peak_rss_kb": children_after.ru_maxrss,
+            "bytes_read": read_after - read_before,
+            "bytes_written": written_after - written_before,
+        })
+
+
+def reset_job_timing(file_id):
+    """Start a fresh timing record for a new or resumed run of the file."""
+    try:
+        get_redis().delete(JOB_TIMING_KEY.format(file_id=file_id))
+    except Exception as e:
+        logger.error(f"Failed to reset the timing record for file_id: {file_id}: {e}")
+
+
+def record_queue_wait(request, file_id=None, batch=None):
+    """Record how long the task behind request sat in the broker before a worker took it."""
+    enqueued_at = getattr(request, 'enqueued_at', None)
+    if enqueued_at is None:
+        return
+    wait = max(0.0, time.time() - float(enqueued_at))
+    record_span({
+        "stage": "queue_wait",
+        "file_id": file_id,
+        "batch": batch,
+        "status": "ok",
+        "started_at": round(float(enqueued_at), 3),
+        "wall_s": round(wait, 4),
+    })
+
+
+def summarize_timing(file_id, raw_spans):
+    """Per-stage totals for a job, plus its batches' total queue wait against execution time."""
+    if not raw_spans:
+        return None
+    spans = [json.loads(raw) for raw in raw_spans]
+    stages = {}
+    for record in spans:
+        totals = stages.setdefault(record["stage"], {"count": 0, "errors": 0, "wall_s": 0.0, "cpu_s": 0.0,
+                                                     "children_cpu_s": 0.0, "bytes_read": 0, "bytes_written": 0})
+        totals["count"] += 1
+        totals["errors"] += record.get("status") == "error"
+        for field in ("wall_s", "cpu_s", "children_cpu_s", "bytes_read", "bytes_written"):
+            totals[field] += record.get(field, 0)
+    for totals in stages.values():
+        for field in ("wall_s", "cpu_s", "children_cpu_s"):
+            totals[field] = round(totals[field], 4)
+
+    started_at = min(record["started_at"] for record in spans)
+    finished_at = max(record["started_at"] + record["wall_s"] for record in spans)
+    return {
+        "file_id": file_id,
+        "elapsed_s": round(finished_at - started_at, 3),
+        "batch_queue_wait_s": stages.get("queue_wait", {}).get("wall_s", 0.0),
+        "batch_exec_s": stages.get("ocr_batch", {}).get("wall_s", 0.0),
+        "stages": stages,
+        "spans": spans,
+    }
+
+
+async def get_job_timing_async(file_id):
+    """The job's timing record for the web handlers, or None if nothing was recorded."""
+    raw_spans = await get_async_redis().lrange(JOB_TIMING_KEY.format(file_id=file_id), 0, -1)
+    return summarize_timing(file_id, raw_spans)
+
+
+def render_metrics(raw, queue_stats=None):
+    """Render the stage counters (and optionally queue depths) in the Prometheus text format."""
+    values = {key.decode() if isinstance(key, bytes) else key: float(value) for key, value in raw.items()}
+    stages = sorted({key.split('|', 1)[0] for key in values})
+    lines = [
+        "# HELP ocr_stage_duration_seconds Wall time of OCR pipeline stages.",
+        "# TYPE ocr_stage_duration_seconds histogram",
+    ]
+    for stage in stages:
+        for bucket in WALL_BUCKETS:
+            lines.append(f'ocr_stage_duration_seconds_bucket{{stage="{stage}",le="{bucket}"}} '
+                         f'{values.get(f"{stage}|bucket|{bucket}", 0):g}')
+        count = values.get(f"{stage}|count", 0)
+        lines.append(f'ocr_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {count:g}')
+        lines.append(f'ocr_stage_duration_seconds_sum{{stage="{stage}"}} {values.get(f"{stage}|wall_s", 0):g}')
+        lines.append(f'ocr_stage_duration_seconds_count{{stage="{stage}"}} {count:g}')
+
+    counters = [
+        ("ocr_stage_cpu_seconds_total", "cpu_s", "CPU time of the worker process in each stage."),
+        ("ocr_stage_children_cpu_seconds_total", "children_cpu_s", "CPU time of OCR subprocesses in each stage."),
+        ("ocr_stage_read_bytes_total", "bytes_read", "Bytes read by the worker process in each stage."),
+        ("ocr_stage_written_bytes_total", "bytes_written", "Bytes written by the worker process in each stage."),
+        ("ocr_stage_errors_total", "errors", "Stage runs that raised."),
+    ]
+    for name, field, help_text in counters:
+        lines.append(f"# HELP {name} {help_text}")
+        lines.append(f"# TYPE {name} counter")
+        for stage in stages:
+            lines.append(f'{name}{{stage="{stage}"}} {values.get(f"{stage}|{field}", 0):g}')
+
+    if queue_stats:
+        lines.append("# HELP ocr_queue_depth Messages waiting in each OCR queue.")
+        lines.append("# TYPE ocr_queue_depth gauge")
+        for queue, stats in queue_stats.items():
+            lines.append(f'ocr_queue_depth{{queue="{queue}"}} {stats["depth"]}')
+    return "\n".join(lines) + "\n"
+
+
+async def get_metrics_text_async(queue_stats=None):
+    return render_metrics(await get_async_redis().hgetall(STAGE_METRICS_KEY), queue_stats)
@@ -0,0 +1,291 @@
+import os
+import json
+import time
+import uuid
+import logging
+from app.redis_client import get_redis
+from app.scheduling import VISIBILITY_TIMEOUT
+
+logger = logging.getLogger(__name__)
+
+# A job is one file's OCR run. Its manifest (file id, bookmark TOC, the batch
+# list and how to dispatch it) is written to Redis once, and the batch tasks
+# and the merge only carry the job id. Each finished batch writes a compact
+# checkpoint record keyed by its page range and decrements the outstanding
+# count in one script; a redelivered batch overwrites its record without
+# counting twice, and the batch that takes the count to zero queues the merge.
+#
+# A batch marks itself running when a worker starts it and its checkpoint
+# clears the mark; the record that completes the job marks the merge running
+# until the merge finishes. Marks sit in one sorted set scored by when they
+# were set, so a mark older than the broker's visibility timeout belongs to
+# work that neither finished nor was redelivered (the message was lost, or
+# the merge was never queued). Batches still waiting in a queue carry no mark
+# and are never taken for stalled. Resuming re-dispatches only the stalled
+# batches, so a crash costs at most the batches that were running.
+#
+# Every start of a batch or merge is counted. Work whose worker keeps dying
+# (e.g. killed for memory, which acks_late would redeliver forever) is given
+# up after JOB_MAX_ATTEMPTS deliveries: a batch gets an error record, a merge
+# fails the file.
+JOB_KEY = "ocr:job:{job_id}"
+JOB_BATCHES_KEY = "ocr:job:{job_id}:batches"
+JOB_ATTEMPTS_KEY = "ocr:job:{job_id}:attempts"
+FILE_JOB_KEY = "ocr:file_job:{file_id}"
+RUNNING_KEY = "ocr:jobs:running"
+MERGE = "merge"
+JOB_TTL = 24 * 3600
+# A running mark older than this is stalled; never below the visibility timeout,
+# or the reaper would duplicate work the broker is about to redeliver
+JOB_STALL_SECONDS = max(int(os.getenv('OCR_JOB_STALL_SECONDS', str(VISIBILITY_TIMEOUT + 900))),
+                        VISIBILITY_TIMEOUT)
+# Resumes a job gets before it is merged as Failed
+JOB_MAX_RESUMES = int(os.getenv('OCR_JOB_MAX_RESUMES', '3'))
+# Deliveries a batch or merge gets before it is given up
+JOB_MAX_ATTEMPTS = int(os.getenv('OCR_JOB_MAX_ATTEMPTS', '3'))
+
+# KEYS[1] = job, KEYS[2] = batch records, KEYS[3] = running marks
+# ARGV[1] = batch key, ARGV[2] = compact result, ARGV[3] = TTL, ARGV[4] = now, ARGV[5] = job id
+# Returns the outstanding batch count, or -1 for a duplicate record or an unknown job.
+# A batch is counted once; a later delivery may turn a failed record into a
+# success, but never replaces a success (the ocr_file slot, index 3, is null on failures)
+RECORD_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[4])
+redis.call('ZREM', KEYS[3], ARGV[5] .. '|' .. ARGV[1])
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous then
+    if cjson.decode(previous)[3] == cjson.null and cjson.decode(ARGV[2])[3] ~= cjson.null then
+        redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+    end
+    return -1
+end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[3])
+local remaining = redis.call('HINCRBY', KEYS[1], 'batches_remaining', -1)
+if remaining == 0 then redis.call('ZADD', KEYS[3], ARGV[4], ARGV[5] .. '|merge') end
+return remaining
+"""
+
+# Drop the failed records and count them as outstanding again, atomically.
+# KEYS as above, ARGV[1] = now, ARGV[2..] = batch keys of failed records
+REOPEN_SCRIPT = """
+if redis.call('EXISTS', KEYS[1]) == 0 then return -1 end
+local reopened = 0
+for i = 2, #ARGV do
+    reopened = reopened + redis.call('HDEL', KEYS[2], ARGV[i])
+end
+redis.call('HINCRBY', KEYS[1], 'resumes', 1)
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[1])
+return redis.call('HINCRBY', KEYS[1], 'batches_remaining', reopened)
+"""
+
+
+def batch_key(start_page, end_page):
+    return f"{start_page}-{end_page}"
+
+
+def running_member(job_id, key):
+    """Running mark of a batch (key from batch_key) or of the merge (key MERGE)."""
+    return f"{job_id}|{key}"
+
+
+def create_job(file_id, toc, batches, ocr_option="basic", page_range=False, user_id=None, queue=None, run_id=None):
+    """
+    Store the job manifest and return its id. batches is the list of
+    (start_page, end_page, path) the job dispatches; run_id ties it to a bulk run.
+    """
+    job_id = uuid.uuid4().hex
+    key = JOB_KEY.format(job_id=job_id)
+    now = time.time()
+    pipeline = get_redis().pipeline()
+    pipeline.hset(key, mapping={
+        "file_id": file_id,
+        "toc": json.dumps(toc, separators=(',', ':')),
+        "batches": json.dumps([list(batch) for batch in batches], separators=(',', ':')),
+        "ocr_option": ocr_option,
+        "page_range": int(bool(page_range)),
+        "user_id": user_id if user_id is not None else '',
+        "queue": queue or '',
+        "run_id": run_id or '',
+        "total_batches": len(batches),
+        "batches_remaining": len(batches),
+        "resumes": 0,
+        "created_at": now,
+        "updated_at": now,
+    })
+    pipeline.expire(key, JOB_TTL)
+    pipeline.set(FILE_JOB_KEY.format(file_id=file_id), job_id, ex=JOB_TTL)
+    pipeline.execute()
+    return job_id
+
+
+def compact_result(result):
+    """Pack a batch result into a short JSON array: [start, end, ocr_file, skipped, hits, misses] or [start, end, None, error]."""
+    if 'error' in result:
+        return [result['start_page'], result['end_page'], None, result['error']]
+    return [result['start_page'], result['end_page'], result['ocr_file'],
+            result['pages_skipped'], result['cache_hits'], result['cache_misses']]
+
+
+def expand_result(entry):
+    start_page, end_page, ocr_file, *rest = entry
+    if ocr_file is None:
+        return {"start_page": start_page, "end_page": end_page, "error": rest[0]}
+    pages_skipped, cache_hits, cache_misses = rest
+    return {
+        "start_page": start_page,
+        "end_page": end_page,
+        "ocr_file": ocr_file,
+        "pages_skipped": pages_skipped,
+        "cache_hits": cache_hits,
+        "cache_misses": cache_misses,
+    }
+
+
+def record_batch(job_id, result):
+    """
+    Write the batch's checkpoint record. Returns the number of batches still
+    outstanding (0 for exactly one call: the job's last batch), or None when the
+    batch was already recorded or the job no longer exists. A recorded success
+    is never overwritten; a recorded failure is replaced only by a success.
+    """
+    remaining = get_redis().eval(
+        RECORD_SCRIPT, 3,
+        JOB_KEY.format(job_id=job_id), JOB_BATCHES_KEY.format(job_id=job_id), RUNNING_KEY,
+        batch_key(result['start_page'], result['end_page']),
+        json.dumps(compact_result(result), separators=(',', ':')),
+        JOB_TTL, time.time(), job_id,
+    )
+    return None if remaining < 0 else remaining
+
+
+def mark_running(job_id, keys, now=None):
+    """Set (or refresh) the running marks of the job's batches or merge (keys from batch_key, or MERGE)."""
+    now = now or time.time()
+    get_redis().zadd(RUNNING_KEY, {running_member(job_id, key): now for key in keys})
+
+
+def start_attempt(job_id, key):
+    """
+    Mark a batch (key from batch_key) or the merge (MERGE) running and count the
+    delivery. Returns the attempt number, 1 for the first delivery.
+    """
+    attempts_key = JOB_ATTEMPTS_KEY.format(job_id=job_id)
+    pipeline = get_redis().pipeline()
+    pipeline.zadd(RUNNING_KEY, {running_member(job_id, key): time.time()})
+    pipeline.hincrby(attempts_key, key, 1)
+    pipeline.expire(attempts_key, JOB_TTL)
+    return pipeline.execute()[1]
+
+
+def completed_batch(job_id, start_page, end_page):
+    """The batch's successful result if it is recorded and its output is still on disk, else None."""
+    entry = get_redis().hget(JOB_BATCHES_KEY.format(job_id=job_id), batch_key(start_page, end_page))
+    if entry is None:
+        return None
+    result = expand_result(json.loads(entry))
+    if 'error' in result or not os.path.exists(result['ocr_file']):
+        return None
+    return result
+
+
+def load_job(job_id):
+    """Return the manifest with its batch results, or None if the job is unknown or expired."""
+    redis_client = get_redis()
+    job = redis_client.hgetall(JOB_KEY.format(job_id=job_id))
+    if not job:
+        return None
+    job = {key.decode(): value.decode() for key, value in job.items()}
+    records = redis_client.hvals(JOB_BATCHES_KEY.format(job_id=job_id))
+    return {
+        "job_id": job_id,
+        "file_id": int(job["file_id"]),
+        "toc": json.loads(job["toc"]),
+        "batches": json.loads(job["batches"]),
+        "ocr_option": job["ocr_option"],
+        "page_range": job["page_range"] == '1',
+        "user_id": int(job["user_id"]) if job["user_id"] else None,
+        "queue": job["queue"] or None,
+        "run_id": job["run_id"] or None,
+        "total_batches": int(job["total_batches"]),
+        "batches_remaining": int(job["batches_remaining"]),
+        "resumes": int(job["resumes"]),
+        "updated_at": float(job["updated_at"]),
+        "results": [expand_result(json.loads(record)) for record in records],
+    }
+
+
+def job_exists(job_id):
+    return bool(get_redis().exists(JOB_KEY.format(job_id=job_id)))
+
+
+def get_file_job(file_id):
+    """Id of the file's most recent job, if it still exists."""
+    job_id = get_redis().get(FILE_JOB_KEY.format(file_id=file_id))
+    return job_id.decode() if job_id is not None else None
+
+
+def reopen_job(job_id, only=None):
+    """
+    Prepare a resume. Without only, failed records are dropped so those batches
+    count as outstanding again, and the batches to dispatch are all (start, end,
+    path) entries without a successful record. With only (a set of batch keys,
+    e.g. the stalled ones) failed records are kept and just those batches are
+    dispatched. Returns (job, batches), or (None, []) for an unknown job.
+    """
+    job = load_job(job_id)
+    if job is None:
+        return None, []
+    failed = [] if only is not None else [
+        batch_key(res['start_page'], res['end_page']) for res in job['results'] if 'error' in res
+    ]
+    if only is None:
+        # A manual resume gives every batch and the merge a fresh set of attempts
+        get_redis().delete(JOB_ATTEMPTS_KEY.format(job_id=job_id))
+    get_redis().eval(
+        REOPEN_SCRIPT, 3,
+        JOB_KEY.format(job_id=job_id), JOB_BATCHES_KEY.format(job_id=job_id), RUNNING_KEY,
+        time.time(), *failed,
+    )
+    # Kept failed records count as recorded: only batches without any record are redone
+    recorded = {batch_key(res['start_page'], res['end_page']) for res in job['results']
+                if only is not None or 'error' not in res}
+    missing = [batch for batch in job['batches'] if batch_key(batch[0], batch[1]) not in recorded
+               and (only is None or batch_key(batch[0], batch[1]) in only)]
+    job['failed_batches'] = set(failed)
+    return job, missing
+
+
+def clear_running(job_id, keys=None):
+    """Drop the given running marks of the job, or all of them (e.g. once it is merged)."""
+    if keys is None:
+        batches = get_redis().hget(JOB_KEY.format(job_id=job_id), "batches")
+        keys = [batch_key(start, end) for start, end, _ in json.loads(batches)] if batches else []
+        keys.append(MERGE)
+    if keys:
+        get_redis().zrem(RUNNING_KEY, *[running_member(job_id, key) for key in keys])
+
+
+def deactivate_job(job_id):
+    """Stop watching the job for stalls; its records stay until they expire so it can still be resumed."""
+    clear_running(job_id)
+
+
+def stalled_work(now=None):
+    """
+    Map of job id to the keys (batch keys, or MERGE) of its work that was marked
+    running more than JOB_STALL_SECONDS ago without finishing.
+    """
+    cutoff = (now or time.time()) - JOB_STALL_SECONDS
+    stalled = {}
+    for member in get_redis().zrangebyscore(RUNNING_KEY, '-inf', cutoff):
+        job_id, key = member.decode().split('|', 1)
+        stalled.setdefault(job_id, set()).add(key)
+    return stalled
+
+
+def delete_job(job_id):
+    clear_running(job_id)
+    get_redis().delete(JOB_KEY.format(job_id=job_id), JOB_BATCHES_KEY.format(job_id=job_id),
+                       JOB_ATTEMPTS_KEY.format(job_id=job_id))
@@ -1,10 +1,10 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Text, Index, UniqueConstraint, Computed
 from sqlalchemy.orm import relationship
 from sqlalchemy.ext.declarative import declarative_base
 from werkzeug.security import generate_password_hash, check_password_hash
 import datetime
 import uuid as uuid_lib
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, TSVECTOR
 
 Base = declarative_base()
 
@@ -33,7 +33,7 @@ class Project(Base):
     id = Column(Integer, primary_key=True)
     name = Column(String(100), nullable=False)
     client_id = Column(Integer, ForeignKey('clients.id'), nullable=False)
-    user_id = Column(Integer, ForeignKey('users.id'), nullable=False)
+    user_id = Column(Integer, ForeignKey('users.id'), nullable=False, index=True)
     client = relationship('Client', back_populates='projects')
     user = relationship('User', back_populates='projects')
     files = relationship('File', back_populates='project')
@@ -42,17 +42,42 @@ class Project(Base):
 class File(Base):
     __tablename__ = 'files'
     id = Column(Integer, primary_key=True)
-    project_id = Column(Integer, ForeignKey('projects.id'), nullable=False)
+    project_id = Column(Integer, ForeignKey('projects.id'), nullable=False, index=True)
     file_name = Column(String(255), nullable=False)
     file_size = Column(Integer, nullable=False)
     file_metadata = Column(Text, nullable=True)
     output_path = Column(String(255), nullable=True)
     file_path = Column(String(255), nullable=False)
-    status = Column(String(50), nullable=False, default='Not processed')
+    status = Column(String(50), nullable=False, default='Not processed', index=True)
     created_at = Column(DateTime, default=datetime.datetime.utcnow)
+    # Bumped on every change so polling clients can fetch only the files that changed
+    updated_at = Column(DateTime, default=datetime.datetime.utcnow, onupdate=datetime.datetime.utcnow, index=True)
     completed_at = Column(DateTime, nullable=True)
+    # Set once every page of the current output is in page_texts
+    text_indexed_at = Column(DateTime, nullable=True)
     uuid = Column(UUID(as_uuid=True), default=uuid_lib.uuid4, unique=True, nullable=False)
     project = relationship('Project', back_populates='files')    
+    # Rows are removed by the database (ON DELETE CASCADE), never loaded just to delete them
+    pages = relationship('PageText', back_populates='file', cascade='all, delete-orphan', passive_deletes=True)
+
+# Text search configuration used for the page index and for queries against it
+TEXT_SEARCH_CONFIG = 'english'
+
+class PageText(Base):
+    """OCR text of one page of a file's output, with a GIN-indexed tsvector for search."""
+    __tablename__ = 'page_texts'
+    id = Column(Integer, primary_key=True)
+    file_id = Column(Integer, ForeignKey('files.id', ondelete='CASCADE'), nullable=False)
+    page_number = Column(Integer, nullable=False)
+    content = Column(Text, nullable=False, default='')
+    search_vector = Column(TSVECTOR, Computed(f"to_tsvector('{TEXT_SEARCH_CONFIG}', content)", persisted=True))
+    indexed_at = Column(DateTime, default=datetime.datetime.utcnow, nullable=False)
+    file = relationship('File', back_populates='pages')
+
+    __table_args__ = (
+        UniqueConstraint('file_id', 'page_number', name='uq_page_texts_file_page'),
+        Index('ix_page_texts_search_vector', 'search_vector', postgresql_using='gin'),
+    )
     
 
 # Establish the back_populates relationship
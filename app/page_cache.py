@@ -0,0 +1,113 @@
+import os
+import hashlib
+import logging
+import uuid
+import fitz
+
+logger = logging.getLogger(__name__)
+
+# Content-addressed cache of OCR'd single-page PDFs, shared by every worker on
+# the host. Entries are keyed by the page content plus the OCR settings, and the
+# least recently used entries are evicted once the cache exceeds its size limit.
+OCR_CACHE_ENABLED = os.getenv('OCR_CACHE_ENABLED', '1') != '0'
+OCR_CACHE_DIR = os.getenv('OCR_CACHE_DIR', 'ocr_cache')
+OCR_CACHE_MAX_BYTES = int(os.getenv('OCR_CACHE_MAX_BYTES', str(2 * 1024 ** 3)))
+
+
+def page_fingerprint(pdf_document, page):
+    """
+    Hash everything that determines how a page renders: its geometry, content
+    streams, the raw image streams it draws and the fonts it references.
+    """
+    digest = hashlib.sha256()
+    digest.update(f"{tuple(page.rect)}:{page.rotation}".encode())
+    digest.update(page.read_contents())
+    for image in page.get_images(full=True):
+        digest.update(pdf_document.xref_stream_raw(image[0]) or b'')
+    for font in page.get_fonts(full=True):
+        digest.update(f"{font[3]}:{font[5]}".encode())
+    return digest.hexdigest()
+
+
+class PageCache:
+
+    def __init__(self, cache_dir=OCR_CACHE_DIR, max_bytes=OCR_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+
+    def page_keys(self, pdf_path, engine_settings, pages=None):
+        """
+        Return one cache key per page of pdf_path (or per 0-indexed page in
+        pages) for the given OCR settings.
+        """
+        pdf_document = fitz.open(pdf_path)
+        try:
+            if pages is None:
+                pages = range(pdf_document.page_count)
+            return [
+                hashlib.sha256(f"{page_fingerprint(pdf_document, pdf_document[page])}:{engine_settings}".encode()).hexdigest()
+                for page in pages
+            ]
+        finally:
+            pdf_document.close()
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.pdf")
+
+    def get(self, key):
+        """Return the cached page path for key, or None on a miss."""
+        path = self.path_for(key)
+        try:
+            # Touch the entry so eviction sees it as recently used
+            os.utime(path)
+        except OSError:
+            return None
+        return path
+
+    def put(self, key, pdf_document, page_number):
+        """Store page_number of an open OCR'd document under key."""
+        path = self.path_for(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        single_page = fitz.open()
+        try:
+            single_page.insert_pdf(pdf_document, from_page=page_number, to_page=page_number)
+            single_page.save(tmp_path, garbage=3, deflate=True)
+        finally:
+            single_page.close()
+        # Atomic so concurrent workers never read a partially written entry
+        os.replace(tmp_path, path)
+
+    def evict(self):
+        """Remove least recently used entries until the cache fits in max_bytes."""
+        entries = []
+        total_size = 0
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if not name.endswith('.pdf'):
+                    continue
+                path = os.path.join(root, name)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total_size += stat.st_size
+
+        if total_size <= self.max_bytes:
+            return
+
+        for _, size, path in sorted(entries):
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                continue
+            if total_size <= self.max_bytes:
+                break
+        logger.info(f"Evicted OCR cache entries, cache size now {total_size} bytes")
+
+
+def get_page_cache():
+    """Return the shared page cache, or None when caching is disabled."""
+    return PageCache() if OCR_CACHE_ENABLED else None
@@ -0,0 +1,94 @@
+import os
+import asyncio
+import logging
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger(__name__)
+
+# Page previews and text are read straight from the finished output with fitz,
+# so checking a page costs one page render rather than a full download.
+# Rendered PNGs are kept in a per-worker LRU bounded by total bytes, keyed by
+# the file's mtime so a re-run output never serves stale images. fitz is
+# imported on first use to keep it out of web workers that never preview.
+# PyMuPDF is not thread safe, so all fitz calls go through one dedicated thread.
+PREVIEW_DEFAULT_DPI = int(os.getenv('PREVIEW_DEFAULT_DPI', '96'))
+PREVIEW_MIN_DPI = 36
+PREVIEW_MAX_DPI = int(os.getenv('PREVIEW_MAX_DPI', '200'))
+PREVIEW_CACHE_MAX_BYTES = int(os.getenv('PREVIEW_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+# Most pages a single text request may cover
+TEXT_MAX_PAGES = int(os.getenv('PREVIEW_TEXT_MAX_PAGES', '50'))
+
+
+class RenderCache:
+    """LRU of rendered page images, bounded by the total size of the images."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self.entries = OrderedDict()
+
+    def get(self, key):
+        image = self.entries.get(key)
+        if image is not None:
+            self.entries.move_to_end(key)
+        return image
+
+    def put(self, key, image):
+        if len(image) > self.max_bytes:
+            return
+        if key in self.entries:
+            self.total_bytes -= len(self.entries.pop(key))
+        self.entries[key] = image
+        self.total_bytes += len(image)
+        while self.total_bytes > self.max_bytes:
+            _, evicted = self.entries.popitem(last=False)
+            self.total_bytes -= len(evicted)
+
+
+render_cache = RenderCache(PREVIEW_CACHE_MAX_BYTES)
+fitz_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='fitz')
+
+
+def clamp_dpi(dpi):
+    return max(PREVIEW_MIN_DPI, min(PREVIEW_MAX_DPI, dpi or PREVIEW_DEFAULT_DPI))
+
+
+def render_page(pdf_path, page_number, dpi):
+    """Render 1-indexed page_number of pdf_path as PNG bytes, or None if the page does not exist."""
+    import fitz
+    with fitz.open(pdf_path) as pdf_document:
+        if not 1 <= page_number <= pdf_document.page_count:
+            return None
+        pixmap = pdf_document[page_number - 1].get_pixmap(dpi=dpi)
+        return pixmap.tobytes("png")
+
+
+def extract_text(pdf_path, start_page, end_page):
+    """Text of the 1-indexed pages start_page..end_page (clipped to the document)."""
+    import fitz
+    with fitz.open(pdf_path) as pdf_document:
+        end_page = min(end_page, pdf_document.page_count)
+        return {
+            "page_count": pdf_document.page_count,
+            "pages": [
+                {"page": page_number, "text": pdf_document[page_number - 1].get_text("text")}
+                for page_number in range(start_page, end_page + 1)
+            ],
+        }
+
+
+async def get_page_image(pdf_path, page_number, dpi):
+    """Cached PNG of the page; rendering runs on the fitz thread so the event loop keeps serving."""
+    key = (pdf_path, os.stat(pdf_path).st_mtime_ns, page_number, dpi)
+    image = render_cache.get(key)
+    if image is None:
+        image = await asyncio.get_running_loop().run_in_executor(fitz_executor, render_page, pdf_path, page_number, dpi)
+        if image is not None:
+            render_cache.put(key, image)
+    return image
+
+
+async def get_page_text(pdf_path, start_page, end_page):
+    end_page = min(end_page, start_page + TEXT_MAX_PAGES - 1)
+    return await asyncio.get_running_loop().run_in_executor(fitz_executor, extract_text, pdf_path, start_page, end_page)
@@ -0,0 +1,140 @@
+import time
+import logging
+from app.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Per-job progress lives in one Redis hash per file, updated by one script
+# call per batch and expired once the uploads are wiped. The last
+# state of every batch is kept next to it, so a batch re-run by a resume or a
+# redelivery is counted once: only a failed batch turning ok moves the counts.
+PROGRESS_KEY = "ocr:progress:{file_id}"
+PROGRESS_BATCHES_KEY = "ocr:progress:{file_id}:batches"
+PROGRESS_TTL = 24 * 3600
+FINISHED_STATES = ('Processed', 'Failed')
+
+# KEYS[1] = progress, KEYS[2] = batch states
+# ARGV[1] = batch key, ARGV[2] = 'ok' or 'failed', ARGV[3] = pages, ARGV[4] = now, ARGV[5] = TTL,
+# ARGV[6..8] = pages skipped, cache hits, cache misses
+RECORD_BATCH_SCRIPT = """
+local previous = redis.call('HGET', KEYS[2], ARGV[1])
+if previous == 'ok' or previous == ARGV[2] then return 0 end
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[2])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+if not previous then redis.call('HINCRBY', KEYS[1], 'batches_done', 1) end
+if ARGV[2] == 'failed' then
+    redis.call('HINCRBY', KEYS[1], 'batches_failed', 1)
+else
+    if previous then redis.call('HINCRBY', KEYS[1], 'batches_failed', -1) end
+    redis.call('HINCRBY', KEYS[1], 'pages_done', ARGV[3])
+    redis.call('HINCRBY', KEYS[1], 'pages_skipped', ARGV[6])
+    redis.call('HINCRBY', KEYS[1], 'cache_hits', ARGV[7])
+    redis.call('HINCRBY', KEYS[1], 'cache_misses', ARGV[8])
+end
+redis.call('HSET', KEYS[1], 'updated_at', ARGV[4])
+return 1
+"""
+
+
+def start_progress(file_id, total_pages, total_batches):
+    """Reset the progress record for a job that is about to dispatch its batches."""
+    key = PROGRESS_KEY.format(file_id=file_id)
+    now = time.time()
+    try:
+        pipeline = get_redis().pipeline()
+        pipeline.delete(key, PROGRESS_BATCHES_KEY.format(file_id=file_id))
+        pipeline.hset(key, mapping={
+            "state": "Processing",
+            "total_pages": total_pages,
+            "total_batches": total_batches,
+            "pages_done": 0,
+            "batches_done": 0,
+            "batches_failed": 0,
+            "pages_skipped": 0,
+            "cache_hits": 0,
+            "cache_misses": 0,
+            "started_at": now,
+            "updated_at": now,
+        })
+        pipeline.expire(key, PROGRESS_TTL)
+        pipeline.execute()
+    except Exception as e:
+        logger.error(f"Failed to start progress tracking for file_id: {file_id}: {e}")
+
+
+def reopen_progress(file_id):
+    """Put a resumed job back into the Processing state, keeping the counts of the batches it kept."""
+    key = PROGRESS_KEY.format(file_id=file_id)
+    try:
+        get_redis().hset(key, mapping={"state": "Processing", "updated_at": time.time()})
+    except Exception as e:
+        logger.error(f"Failed to reopen progress tracking for file_id: {file_id}: {e}")
+
+
+def record_batch_done(file_id, start_page, end_page, failed=False, page_stats=None):
+    """Count a finished batch, its pages and its skipped/cached pages towards the job's progress, once."""
+    page_stats = page_stats or {}
+    try:
+        get_redis().eval(
+            RECORD_BATCH_SCRIPT, 2, PROGRESS_KEY.format(file_id=file_id), PROGRESS_BATCHES_KEY.format(file_id=file_id),
+            f"{start_page}-{end_page}", 'failed' if failed else 'ok', end_page - start_page + 1, time.time(),
+            PROGRESS_TTL, page_stats.get("skipped", 0), page_stats.get("hits", 0), page_stats.get("misses", 0),
+        )
+    except Exception as e:
+        logger.error(f"Failed to record batch progress for file_id: {file_id}: {e}")
+
+
+def finish_progress(file_id, state):
+    """Mark the job as finished with its final file status."""
+    key = PROGRESS_KEY.format(file_id=file_id)
+    try:
+        get_redis().hset(key, mapping={"state": state, "updated_at": time.time()})
+    except Exception as e:
+        logger.error(f"Failed to finish progress tracking for file_id: {file_id}: {e}")
+
+
+def summarize_progress(file_id, raw):
+    """Turn the raw Redis hash into counts, throughput and ETA."""
+    if not raw:
+        return None
+    raw = {k.decode() if isinstance(k, bytes) else k: v.decode() if isinstance(v, bytes) else v
+           for k, v in raw.items()}
+    total_pages = int(raw.get("total_pages", 0))
+    pages_done = int(raw.get("pages_done", 0))
+    started_at = float(raw.get("started_at", 0))
+    updated_at = float(raw.get("updated_at", started_at))
+    state = raw.get("state", "Processing")
+
+    # Measure throughput up to now while running, and up to the last update once finished
+    elapsed = (updated_at if state in FINISHED_STATES else time.time()) - started_at
+    pages_per_second = pages_done / elapsed if elapsed > 0 else 0.0
+    eta_seconds = None
+    if state not in FINISHED_STATES and pages_per_second > 0:
+        eta_seconds = round((total_pages - pages_done) / pages_per_second, 1)
+
+    return {
+        "file_id": file_id,
+        "state": state,
+        "pages_done": pages_done,
+        "total_pages": total_pages,
+        "batches_done": int(raw.get("batches_done", 0)),
+        "batches_failed": int(raw.get("batches_failed", 0)),
+        "total_batches": int(raw.get("total_batches", 0)),
+        "pages_skipped": int(raw.get("pages_skipped", 0)),
+        "cache_hits": int(raw.get("cache_hits", 0)),
+        "cache_misses": int(raw.get("cache_misses", 0)),
+        "percent": round(100.0 * pages_done / total_pages, 1) if total_pages else 0.0,
+        "elapsed_seconds": round(max(elapsed, 0.0), 1),
+        "pages_per_second": round(pages_per_second, 3),
+        "eta_seconds": eta_seconds,
+    }
+
+
+def get_progress(file_id):
+    """Return the job's progress summary, or None if there is no record."""
+    return summarize_progress(file_id, get_redis().hgetall(PROGRESS_KEY.format(file_id=file_id)))
+
+
+async def get_progress_async(file_id):
+    """Event-loop friendly variant of get_progress for the web handlers."""
+    return summarize_progress(file_id, await get_async_redis().hgetall(PROGRESS_KEY.format(file_id=file_id)))
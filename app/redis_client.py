@@ -0,0 +1,26 @@
+import os
+import redis
+import redis.asyncio as async_redis
+
+# Shared Redis connection for coordination state (CPU budget, progress, ...).
+# Falls back to the Celery broker, which is Redis in every deployment.
+REDIS_URL = os.getenv('REDIS_URL') or os.getenv('CELERY_BROKER_URL') or 'redis://localhost:6379/0'
+
+_redis_client = None
+_async_redis_client = None
+
+
+def get_redis():
+    """Return the process-wide Redis client, creating it on first use."""
+    global _redis_client
+    if _redis_client is None:
+        _redis_client = redis.Redis.from_url(REDIS_URL, socket_timeout=5)
+    return _redis_client
+
+
+def get_async_redis():
+    """Return the process-wide asyncio Redis client for the Sanic handlers."""
+    global _async_redis_client
+    if _async_redis_client is None:
+        _async_redis_client = async_redis.Redis.from_url(REDIS_URL, socket_timeout=5)
+    return _async_redis_client
@@ -0,0 +1,132 @@
+import os
+import time
+import logging
+from celery.signals import before_task_publish, task_prerun, task_postrun
+from app.redis_client import get_redis, get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Work is split into two Celery queues. Small documents go to the interactive
+# queue, which workers always drain first; everything else goes to the bulk
+# queue and soaks up whatever capacity is left. Within a queue, a batch's
+# priority drops with the amount of work its user already has queued, so one
+# user's 5,000-page production is interleaved with everyone else's batches
+# instead of running ahead of them.
+INTERACTIVE_QUEUE = 'ocr_interactive'
+BULK_QUEUE = 'ocr_bulk'
+OCR_QUEUES = (INTERACTIVE_QUEUE, BULK_QUEUE)
+INTERACTIVE_MAX_PAGES = int(os.getenv('OCR_INTERACTIVE_MAX_PAGES', '100'))
+# Queued batches a user may have before their next batches drop one priority level
+FAIR_SHARE_STEP = int(os.getenv('OCR_FAIR_SHARE_STEP', '4'))
+
+# Redis transport: priorities 0 (first) to 9, and queues consumed in the order the
+# worker lists them rather than round-robin
+PRIORITY_LEVELS = 10
+# Late-acknowledged tasks that were never acked (their worker died) are redelivered
+# once this many seconds pass; keep it above the longest batch
+VISIBILITY_TIMEOUT = int(os.getenv('OCR_VISIBILITY_TIMEOUT', '3600'))
+BROKER_TRANSPORT_OPTIONS = {
+    'priority_steps': list(range(PRIORITY_LEVELS)),
+    'sep': ':',
+    'queue_order_strategy': 'priority',
+    'visibility_timeout': VISIBILITY_TIMEOUT,
+}
+
+BACKLOG_KEY = "ocr:sched:backlog:{user_id}"
+WAIT_KEY = "ocr:sched:wait:{queue}"
+RECENT_WAITS = 200
+BACKLOG_TTL = 24 * 3600
+
+
+def job_queue(total_pages, bulk=False):
+    """Pick the queue for a job from its size and whether it was submitted as bulk work."""
+    if bulk or total_pages > INTERACTIVE_MAX_PAGES:
+        return BULK_QUEUE
+    return INTERACTIVE_QUEUE
+
+
+def schedule_batches(signatures, user_id, queue):
+    """
+    Route the batch signatures to queue with fair-share priorities, counting
+    them against the user's backlog. Returns the signatures for chaining.
+    """
+    key = BACKLOG_KEY.format(user_id=user_id)
+    try:
+        backlog = int(get_redis().incrby(key, len(signatures))) - len(signatures)
+        get_redis().expire(key, BACKLOG_TTL)
+    except Exception as e:
+        logger.error(f"Failed to read the OCR backlog for user {user_id}, scheduling without fair share. Error: {e}")
+        backlog = 0
+
+    for position, signature in enumerate(signatures):
+        priority = min(PRIORITY_LEVELS - 1, (backlog + position) // FAIR_SHARE_STEP)
+        signature.set(queue=queue, priority=priority, headers={'ocr_user_id': user_id})
+    return signatures
+
+
+def queue_depth(redis_client, queue):
+    """Messages waiting in queue across all its priority lists (Redis transport layout)."""
+    sep = BROKER_TRANSPORT_OPTIONS['sep']
+    pipeline = redis_client.pipeline()
+    for priority in range(PRIORITY_LEVELS):
+        pipeline.llen(queue if priority == 0 else f"{queue}{sep}{priority}")
+    return pipeline
+
+
+def summarize_waits(recent):
+    waits = sorted(float(wait) for wait in recent)
+    if not waits:
+        return {"samples": 0, "avg_s": None, "p95_s": None, "max_s": None}
+    return {
+        "samples": len(waits),
+        "avg_s": round(sum(waits) / len(waits), 3),
+        "p95_s": round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 3),
+        "max_s": round(waits[-1], 3),
+    }
+
+
+async def get_queue_stats_async():
+    """Queue depth and recent queue wait times for every OCR queue."""
+    redis_client = get_async_redis()
+    stats = {}
+    for queue in OCR_QUEUES:
+        depths = await queue_depth(redis_client, queue).execute()
+        recent = await redis_client.lrange(WAIT_KEY.format(queue=queue), 0, -1)
+        stats[queue] = {"depth": sum(depths), "wait": summarize_waits(recent)}
+    return stats
+
+
+@before_task_publish.connect
+def stamp_enqueue_time(headers=None, **kwargs):
+    if headers is not None:
+        headers.setdefault('enqueued_at', time.time())
+
+
+@task_prerun.connect
+def record_queue_wait(task=None, **kwargs):
+    enqueued_at = getattr(task.request, 'enqueued_at', None)
+    queue = (task.request.delivery_info or {}).get('routing_key')
+    if enqueued_at is None or queue not in OCR_QUEUES:
+        return
+    wait = max(0.0, time.time() - float(enqueued_at))
+    try:
+        key = WAIT_KEY.format(queue=queue)
+        pipeline = get_redis().pipeline()
+        pipeline.lpush(key, round(wait, 3))
+        pipeline.ltrim(key, 0, RECENT_WAITS - 1)
+        pipeline.execute()
+    except Exception as e:
+        logger.error(f"Failed to record queue wait for {task.name}. Error: {e}")
+
+
+@task_postrun.connect
+def release_backlog(task=None, **kwargs):
+    user_id = getattr(task.request, 'ocr_user_id', None)
+    if user_id is None:
+        return
+    try:
+        key = BACKLOG_KEY.format(user_id=user_id)
+        if get_redis().decr(key) < 0:
+            get_redis().set(key, 0)
+    except Exception as e:
+        logger.error(f"Failed to release OCR backlog for user {user_id}. Error: {e}")
@@ -0,0 +1,65 @@
+import os
+import json
+import logging
+from types import SimpleNamespace
+from sanic_session import AIORedisSessionInterface
+from app.models import User
+from app.db import async_session_scope
+from app.redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Sessions live in Redis so every Sanic worker, on any node, sees the same
+# session. The user behind a request is looked up through a short-lived Redis
+# cache instead of a users-table query on every page render; logging out drops
+# the cached entry straight away and the TTL bounds staleness otherwise.
+SESSION_PREFIX = "ocr:session:"
+SESSION_TTL = int(os.getenv('SESSION_TTL', str(3600)))
+USER_CACHE_KEY = "ocr:user:{user_id}"
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+
+def session_interface(secure=False):
+    """Redis-backed sanic_session interface sharing the app's asyncio Redis client."""
+    return AIORedisSessionInterface(
+        get_async_redis(),
+        prefix=SESSION_PREFIX,
+        expiry=SESSION_TTL,
+        httponly=True,
+        secure=secure,
+    )
+
+
+async def get_cached_user(user_id):
+    """
+    Return the user (id, fullname, email) for user_id, from the Redis cache
+    when possible and from the database otherwise. None if there is no such user.
+    """
+    key = USER_CACHE_KEY.format(user_id=user_id)
+    redis_client = get_async_redis()
+    try:
+        cached = await redis_client.get(key)
+        if cached is not None:
+            return SimpleNamespace(**json.loads(cached))
+    except Exception as e:
+        logger.error(f"Failed to read the user cache for user {user_id}, falling back to the database. Error: {e}")
+
+    async with async_session_scope() as session:
+        user = await session.get(User, user_id)
+        if user is None:
+            return None
+        fields = {"id": user.id, "fullname": user.fullname, "email": user.email}
+
+    try:
+        await redis_client.set(key, json.dumps(fields), ex=USER_CACHE_TTL)
+    except Exception as e:
+        logger.error(f"Failed to cache user {user_id}. Error: {e}")
+    return SimpleNamespace(**fields)
+
+
+async def invalidate_user(user_id):
+    """Drop the cached user so the next request reloads it."""
+    try:
+        await get_async_redis().delete(USER_CACHE_KEY.format(user_id=user_id))
+    except Exception as e:
+        logger.error(f"Failed to invalidate the cached user {user_id}. Error: {e}")
@@ -1,17 +1,19 @@
-from celery import Celery, group, chain, chord
-from config import CeleryConfig
-from app.utils import extract_bookmarks_to_dataframe, reattach_bookmarks_from_dataframe, burst_pdf, merge_pdf, apply_ocr_on_pdf, session_scope, cleanup_tmp_dir
-from app.models import File
-from datetime import datetime
+from app.celery_app import celery
+from app.utils import extract_bookmarks, burst_pdf, merge_pdf_with_bookmarks, apply_ocr_on_pdf, session_scope, get_worker_concurrency
+from app.models import File, Project, PageText
+from app.progress import start_progress, reopen_progress, record_batch_done, finish_progress
+from app.scheduling import BULK_QUEUE, PRIORITY_LEVELS, job_queue, schedule_batches
+from app import bulk, jobs
+from app.instrumentation import span, record_queue_wait, reset_job_timing
+from app.redis_client import get_redis
+from datetime import datetime, timedelta
+from sqlalchemy import func
+from sqlalchemy.dialects.postgresql import insert
 import os
 import gc
 import fitz 
-import pandas as pd
 
 
-celery = Celery('ocr_tasks')
-celery.config_from_object(CeleryConfig)
-
 
 @celery.task
 def ocr_pdf_file(file_id, ocr_option="basic"):
@@ -20,61 +22,137 @@ def ocr_pdf_file(file_id, ocr_option="basic"):
         if not file_entry:
             return
 
-        # Step 1: Extract bookmarks before processing and convert DataFrame to list of dicts
-        bookmarks_df = extract_bookmarks_to_dataframe(file_entry.file_path)
-        bookmarks_list = bookmarks_df.to_dict(orient='records')  # Convert DataFrame to list of dicts for serialization
+        # Step 1: Extract bookmarks before processing as a compact [level, title, page] TOC
+        reset_job_timing(file_id)
+        with span("extract_bookmarks", file_id):
+            bookmarks_list = extract_bookmarks(file_entry.file_path)
 
         # Step 2: Burst the PDF into batches
-        batch_files = burst_pdf(file_entry.file_path)
+        with span("burst_pdf", file_id):
+            batch_files, batch_plan = burst_pdf(file_entry.file_path)
+        if batch_plan:
+            print(f"Batch plan for file {file_id}: {batch_plan['batch_count']} batches over "
+                  f"{batch_plan['total_pages']} pages for {batch_plan['worker_concurrency']} workers "
+                  f"(target cost {batch_plan['target_cost']} per batch)")
         if not batch_files:
+            file_entry.status = 'Failed'
+            finish_progress(file_id, 'Failed')
             return {"error": "Failed to burst the PDF", "file_path": file_entry.file_path}
 
-        # Step 3: Create a group of OCR tasks
-        ocr_tasks = [
-            ocr_pdf_page_batch.s(file_id, batch_file, start_page, end_page, ocr_option)
-            for start_page, end_page, batch_file in batch_files
-        ]
+        start_progress(file_id, batch_plan['total_pages'], len(batch_files))
+
+        # Step 3: Store the job manifest once; batches and the merge only carry its id.
+        # Small jobs jump the bulk queue, and batches are prioritised by their user's backlog
+        page_range = batch_plan['mode'] == 'ranges'
+        queue = job_queue(batch_plan['total_pages'])
+        user_id = file_entry.project.user_id
+        job_id = jobs.create_job(file_id, bookmarks_list, batch_files, ocr_option, page_range, user_id, queue)
+
+        # Step 4: Dispatch the batches. The last one to finish queues merge_ocr_batches
+        dispatch_job_batches(job_id, file_id, batch_files, ocr_option, page_range, user_id, queue)
+        return job_id
+
 
-        # Step 4: Use a chord to wait for all OCR tasks to finish before triggering merge_ocr_batches
-        callback = merge_ocr_batches.s(file_id, bookmarks_list)
-        
-        workflow = chord(ocr_tasks)(callback)
-        return workflow
+def dispatch_job_batches(job_id, file_id, batches, ocr_option, page_range, user_id, queue):
+    ocr_tasks = [
+        ocr_job_batch.s(job_id, file_id, batch_file, start_page, end_page, ocr_option, page_range)
+        for start_page, end_page, batch_file in batches
+    ]
+    for ocr_task in schedule_batches(ocr_tasks, user_id, queue):
+        ocr_task.apply_async()
+
+
+def queue_merge(job_id, file_id, run_id=None):
+    """Queue the job's merge; bulk-run jobs report back to their run once merged."""
+    jobs.mark_running(job_id, [jobs.MERGE])
+    if run_id:
+        merge_ocr_batches.apply_async((job_id,), link=finish_bulk_file.si(run_id, file_id))
+    else:
+        merge_ocr_batches.delay(job_id)
  
 
+def abandoned_batch(file_id, start_page, end_page, attempt):
+    """Error result for a batch whose earlier deliveries all died before recording a result."""
+    print(f"Batch {start_page}-{end_page} of file {file_id} never finished in {attempt - 1} deliveries, giving up")
+    record_batch_done(file_id, start_page, end_page, failed=True)
+    return {"error": f"Never finished in {attempt - 1} deliveries", "start_page": start_page, "end_page": end_page}
+
+
 @celery.task
-def ocr_pdf_page_batch(file_id, batch_file_path, start_page, end_page, ocr_option="basic"):
+def ocr_pdf_page_batch(file_id, batch_file_path, start_page, end_page, ocr_option="basic", page_range=False):
     try:
         if not os.path.exists(batch_file_path):
             raise FileNotFoundError(f"Batch file not found: {batch_file_path}")
 
-        # Step 4: Apply OCR to the batch file, passing the selected OCR option
-        ocr_file = apply_ocr_on_pdf(batch_file_path, file_id, ocr_option)
+        # Step 4: Apply OCR to the batch, passing the selected OCR option. With page_range
+        # the batch file is the whole source document and only start_page..end_page are OCR'd
+        with span("ocr_batch", file_id, f"{start_page}-{end_page}"):
+            ocr_file, page_stats = apply_ocr_on_pdf(
+                batch_file_path, file_id, ocr_option,
+                page_range=(start_page, end_page) if page_range else None
+            )
+        record_batch_done(file_id, start_page, end_page, page_stats=page_stats)
         return {
             "start_page": start_page,
             "end_page": end_page,
-            "ocr_file": ocr_file
+            "ocr_file": ocr_file,
+            "pages_skipped": page_stats["skipped"],
+            "cache_hits": page_stats["hits"],
+            "cache_misses": page_stats["misses"]
         }
     except Exception as e:
-        return {"error": str(e), "batch_file_path": batch_file_path}
+        record_batch_done(file_id, start_page, end_page, failed=True)
+        return {"error": str(e), "batch_file_path": batch_file_path, "start_page": start_page, "end_page": end_page}
 
 
-@celery.task
-def merge_ocr_batches(results, file_id, bookmarks_list):
+# Batches and merges are idempotent, so they are acknowledged only once they
+# finish: if the worker dies, the broker redelivers them to another worker.
+@celery.task(bind=True, ignore_result=True, acks_late=True, reject_on_worker_lost=True)
+def ocr_job_batch(self, job_id, file_id, batch_file_path, start_page, end_page, ocr_option="basic", page_range=False):
+    """OCR one batch of a job and queue the merge if it was the job's last outstanding batch."""
+    record_queue_wait(self.request, file_id, f"{start_page}-{end_page}")
+    if jobs.completed_batch(job_id, start_page, end_page):
+        return  # redelivered after it had already been checkpointed
+    attempt = jobs.start_attempt(job_id, jobs.batch_key(start_page, end_page))
+    if attempt > jobs.JOB_MAX_ATTEMPTS:
+        result = abandoned_batch(file_id, start_page, end_page, attempt)
+    else:
+        result = ocr_pdf_page_batch(file_id, batch_file_path, start_page, end_page, ocr_option, page_range)
+    if jobs.record_batch(job_id, result) == 0:
+        queue_merge(job_id, file_id)
+
+
+@celery.task(acks_late=True, reject_on_worker_lost=True)
+def merge_ocr_batches(job_id):
+    # Step 5: Load the job manifest and the compact batch results
+    job = jobs.load_job(job_id)
+    if job is None:
+        print(f"Job {job_id} not found or expired, nothing to merge")
+        return
+    file_id, bookmarks_list, results = job['file_id'], job['toc'], job['results']
+    attempt = jobs.start_attempt(job_id, jobs.MERGE)
+    if attempt > jobs.JOB_MAX_ATTEMPTS:
+        print(f"Merge of job {job_id} never finished in {attempt - 1} deliveries, failing file {file_id}")
+        with session_scope() as session:
+            file_entry = session.query(File).filter_by(id=file_id).first()
+            if file_entry:
+                file_entry.status = 'Failed'
+        finish_progress(file_id, 'Failed')
+        jobs.deactivate_job(job_id)
+        return
+    missing_batches = job['total_batches'] - len(results)
+    if missing_batches:
+        print(f"Job {job_id} is missing {missing_batches} of {job['total_batches']} batch results")
+
     with session_scope() as session:
         file_entry = session.query(File).filter_by(id=file_id).first()
         if not file_entry:
+            jobs.delete_job(job_id)
             return
 
-        # Step 5: Verify results
-        print(f"Raw results: {results}")
-        if isinstance(results, dict):
-            results = [results]
-
-        # Verify if results is a list
-        if not isinstance(results, list):
-            print(f"Unexpected results format: {results}")
-            return
+        failed_results = [res for res in results if 'error' in res]
+        for res in failed_results:
+            print(f"Batch failed for file {file_id}: {res}")
 
         try:
             # Step 6: Sort the results by 'start_page'
@@ -82,30 +160,27 @@ def merge_ocr_batches(results, file_id, bookmarks_list):
             output_dir = os.path.dirname(file_entry.file_path)
             ocr_files = [res['ocr_file'] for res in sorted_results if 'ocr_file' in res]
 
-            # Step 7: Merge the OCR'ed PDF files into one final PDF
-            final_pdf_path = merge_pdf(ocr_files, output_dir, file_entry.file_name)
-
-            # Step 8: Convert the list of dicts back to a DataFrame
-            bookmarks_df = pd.DataFrame(bookmarks_list)
-            
-            # Step 9: Ensure final renaming happens correctly
-            final_renamed_pdf_path = os.path.join(output_dir, f"{os.path.splitext(file_entry.file_name)[0]}_OCRed.pdf")
-            if os.path.exists(final_pdf_path):
-                os.rename(final_pdf_path, final_renamed_pdf_path)
-                
-            # Get number of pages in the final PDF
-            pdf_document = fitz.open(final_renamed_pdf_path)
-            total_pages = pdf_document.page_count
-            pdf_document.close()
-                
-            # Step 10: Reattach the bookmarks to the final PDF
-            reattach_bookmarks_from_dataframe(final_renamed_pdf_path, bookmarks_df, 1, total_pages)  #len(sorted_results))
-            
-            # Step 11: Update file entry status
-            # file_entry.output_path = final_renamed_pdf_path
-            # file_entry.status = 'Processed'
-            # file_entry.completed_at = datetime.utcnow()
-            # session.commit()
+            # Report how much of this job skipped OCR or was served from the page cache
+            pages_skipped = sum(res.get('pages_skipped', 0) for res in sorted_results)
+            cache_hits = sum(res.get('cache_hits', 0) for res in sorted_results)
+            cache_misses = sum(res.get('cache_misses', 0) for res in sorted_results)
+            print(f"Page stats for file {file_id}: {pages_skipped} pages skipped (text layer present), "
+                  f"{cache_hits} cache hits, {cache_misses} pages OCR'd")
+
+            # Step 7: Update file entry status. This is the only place a job becomes
+            # 'Processed'; a failed or missing batch leaves the whole file 'Failed' and
+            # no final file is written, so a document with pages missing is never served
+            if failed_results or missing_batches or file_entry.status == 'Failed':
+                file_entry.status = 'Failed'
+            else:
+                # Step 8: Merge the OCR'ed PDF files and reattach the bookmarks in one pass
+                with span("merge_with_bookmarks", file_id):
+                    final_pdf_path = merge_pdf_with_bookmarks(ocr_files, bookmarks_list, output_dir,
+                                                              file_entry.file_name)
+                file_entry.output_path = final_pdf_path
+                file_entry.status = 'Processed'
+            file_entry.completed_at = datetime.utcnow()
+            session.commit()
 
             # Cleanup temporary directory
             # tmp_dir = os.path.join(output_dir, 'tmp')
@@ -113,12 +188,294 @@ def merge_ocr_batches(results, file_id, bookmarks_list):
 
         except KeyError as e:
             print(f"Error merging PDFs: missing key {e}")
+            file_entry.status = 'Failed'
         except Exception as e:
             print(f"General error during merging: {e}")
-            
-        gc.collect()
+            file_entry.status = 'Failed'
+
+        finish_progress(file_id, file_entry.status)
+        if file_entry.status == 'Processed':
+            # Index the text off the OCR path: bulk queue, lowest priority
+            index_file_text.apply_async((file_id,), queue=BULK_QUEUE, priority=PRIORITY_LEVELS - 1)
+            jobs.delete_job(job_id)
+        else:
+            # Keep the checkpoints so a resume only redoes the failed or missing batches
+            jobs.deactivate_job(job_id)
+    gc.collect()
+
+
+# Pages extracted and written per transaction when indexing a file's text
+TEXT_INDEX_BATCH_PAGES = int(os.getenv('OCR_TEXT_INDEX_BATCH_PAGES', '200'))
 
 
 @celery.task
-def ocr_pdf_folder(folder_path, project_id):
-    pass
+def index_file_text(file_id):
+    """
+    Store the text of every page of the file's output in page_texts for full-text
+    search. Pages are written in batches, each in its own transaction, and an
+    interrupted run resumes after the last page it stored.
+    """
+    with session_scope() as session:
+        file_entry = session.query(File).filter_by(id=file_id).first()
+        if not file_entry or file_entry.status != 'Processed' or not file_entry.output_path:
+            return
+        if file_entry.text_indexed_at and file_entry.completed_at and file_entry.text_indexed_at >= file_entry.completed_at:
+            return  # the current output is already indexed
+
+        # Rows written before the current output was merged belong to an earlier run
+        if file_entry.completed_at:
+            session.query(PageText).filter(
+                PageText.file_id == file_id, PageText.indexed_at < file_entry.completed_at
+            ).delete(synchronize_session=False)
+        last_page = session.query(func.max(PageText.page_number)).filter(PageText.file_id == file_id).scalar() or 0
+        session.commit()
+
+        with span("index_text", file_id), fitz.open(file_entry.output_path) as pdf_document:
+            for batch_start in range(last_page, pdf_document.page_count, TEXT_INDEX_BATCH_PAGES):
+                batch_end = min(batch_start + TEXT_INDEX_BATCH_PAGES, pdf_document.page_count)
+                rows = [
+                    {
+                        "file_id": file_id,
+                        "page_number": page + 1,
+                        # PostgreSQL text cannot hold NUL characters
+                        "content": pdf_document[page].get_text("text").replace('\x00', ''),
+                        "indexed_at": datetime.utcnow(),
+                    }
+                    for page in range(batch_start, batch_end)
+                ]
+                statement = insert(PageText).values(rows)
+                session.execute(statement.on_conflict_do_update(
+                    constraint='uq_page_texts_file_page',
+                    set_={"content": statement.excluded.content, "indexed_at": statement.excluded.indexed_at},
+                ))
+                session.commit()
+
+        file_entry.text_indexed_at = datetime.utcnow()
+        session.commit()
+
+
+# Batches a bulk run may have queued or running at once
+BULK_MAX_IN_FLIGHT = int(os.getenv('OCR_BULK_MAX_IN_FLIGHT', '0'))
+BULK_OUTPUT_SUFFIX = '_OCRed_with_bookmarks.pdf'
+
+
+def find_untracked_pdfs(session, folder_path, project_id):
+    """Register PDFs found under folder_path that have no File row yet."""
+    known_paths = {os.path.abspath(path) for (path,) in session.query(File.file_path).filter_by(project_id=project_id)}
+    new_files = []
+    for root, dirs, names in os.walk(folder_path):
+        dirs[:] = [name for name in dirs if name != 'tmp']  # Skip burst/engine scratch directories
+        for name in sorted(names):
+            path = os.path.join(root, name)
+            if not name.lower().endswith('.pdf') or name.endswith(BULK_OUTPUT_SUFFIX) or os.path.abspath(path) in known_paths:
+                continue
+            file_entry = File(
+                project_id=project_id,
+                file_name=name,
+                file_size=os.path.getsize(path),
+                file_path=path,
+                status='Not processed'
+            )
+            session.add(file_entry)
+            new_files.append(file_entry)
+    session.flush()
+    return new_files
+
+
+@celery.task
+def ocr_pdf_folder(folder_path, project_id, ocr_option="basic"):
+    """
+    OCR every pending file of a project (optionally only those under
+    folder_path) as one bulk run sharing a page-level work queue.
+    """
+    with session_scope() as session:
+        project = session.query(Project).filter_by(id=project_id).first()
+        if not project:
+            return
+
+        query = session.query(File).filter(File.project_id == project_id, File.status.in_(['Not processed', 'Failed']))
+        file_entries = query.order_by(File.id).all()
+        if folder_path:
+            folder = os.path.abspath(folder_path) + os.sep
+            file_entries = [entry for entry in file_entries if os.path.abspath(entry.file_path).startswith(folder)]
+            file_entries += find_untracked_pdfs(session, folder_path, project_id)
+
+        max_in_flight = BULK_MAX_IN_FLIGHT or 2 * get_worker_concurrency()
+        run_id = bulk.create_run(project_id, project.user_id, ocr_option, max_in_flight, len(file_entries))
+        print(f"Bulk OCR run {run_id} for project {project_id}: {len(file_entries)} files, "
+              f"at most {max_in_flight} batches in flight")
+
+        for file_entry in file_entries:
+            file_entry.status = 'Processing'
+            reset_job_timing(file_entry.id)
+            with span("extract_bookmarks", file_entry.id):
+                bookmarks_list = extract_bookmarks(file_entry.file_path)
+            with span("burst_pdf", file_entry.id):
+                batch_files, batch_plan = burst_pdf(file_entry.file_path, mode='ranges')
+            if not batch_files:
+                file_entry.status = 'Failed'
+                finish_progress(file_entry.id, 'Failed')
+                bulk.add_failed_file(run_id, file_entry.id)
+                continue
+
+            start_progress(file_entry.id, batch_plan['total_pages'], len(batch_files))
+            job_id = jobs.create_job(file_entry.id, bookmarks_list, batch_files, ocr_option, True,
+                                     project.user_id, BULK_QUEUE, run_id)
+            bulk.add_file(run_id, file_entry.id, job_id, batch_files)
+            session.commit()
+            # Start feeding workers while the remaining files are still being planned
+            dispatch_bulk_batches(run_id)
+
+        session.commit()
+        bulk.close_run_if_finished(run_id)
+        return run_id
+
+
+def dispatch_bulk_batches(run_id):
+    """Send queued work items of the run to the bulk queue, up to its in-flight bound."""
+    run = bulk.get_run(run_id)
+    items = bulk.claim_items(run_id)
+    if not items:
+        return
+    signatures = [ocr_bulk_batch.s(run_id, item, run['ocr_option']) for item in items]
+    for signature in schedule_batches(signatures, int(run['user_id']), BULK_QUEUE):
+        signature.apply_async()
+
+
+@celery.task(bind=True, acks_late=True, reject_on_worker_lost=True)
+def ocr_bulk_batch(self, run_id, item, ocr_option="basic"):
+    """OCR one work item of a bulk run, merge its file if it was the last batch, then refill the queue."""
+    file_id = item['file_id']
+    record_queue_wait(self.request, file_id, f"{item['start_page']}-{item['end_page']}")
+    try:
+        if jobs.completed_batch(item['job_id'], item['start_page'], item['end_page']):
+            return  # redelivered after it had already been checkpointed
+        attempt = jobs.start_attempt(item['job_id'], jobs.batch_key(item['start_page'], item['end_page']))
+        if attempt > jobs.JOB_MAX_ATTEMPTS:
+            result = abandoned_batch(file_id, item['start_page'], item['end_page'], attempt)
+        else:
+            result = ocr_pdf_page_batch(file_id, item['path'], item['start_page'], item['end_page'],
+                                        ocr_option, True)
+        remaining = jobs.record_batch(item['job_id'], result)
+        if remaining is None and jobs.job_exists(item['job_id']):
+            return  # a duplicate delivery recorded this batch first and freed its slot
+        # Count it (and free its slot) even when the job expired under it
+        bulk.record_batch(run_id, item['job_id'], result)
+        if remaining == 0:
+            queue_merge(item['job_id'], file_id, run_id)
+    finally:
+        dispatch_bulk_batches(run_id)
+
+
+@celery.task
+def finish_bulk_file(run_id, file_id):
+    with session_scope() as session:
+        file_entry = session.query(File).filter_by(id=file_id).first()
+        failed = file_entry is None or file_entry.status != 'Processed'
+    bulk.record_file_done(run_id, file_id, failed)
+
+
+def resume_job(job_id, only=None):
+    """
+    Re-dispatch only the job's batches that have no successful checkpoint (or,
+    with only, just those of the given batch keys that have no record at all),
+    or queue its merge if every batch is recorded. Returns the job, or None if
+    it no longer exists.
+    """
+    job, batches = jobs.reopen_job(job_id, only)
+    if job is None:
+        return None
+    file_id, run_id = job['file_id'], job['run_id']
+    reopen_progress(file_id)
+    if only is None:
+        # A stalled-batch resume continues the same run; its spans so far still count
+        reset_job_timing(file_id)
+    queued = set()
+    if run_id:
+        # Items still waiting in the run's own queue will be dispatched by the run
+        queued = {(item['start_page'], item['end_page']) for item in bulk.queued_items(run_id)
+                  if item.get('job_id') == job_id}
+        batches = [batch for batch in batches if (batch[0], batch[1]) not in queued]
+    print(f"Resuming job {job_id} for file {file_id}: {len(batches)} of {job['total_batches']} batches to redo")
+
+    if not batches:
+        if not queued:
+            queue_merge(job_id, file_id, run_id)
+        return job
+
+    if run_id:
+        # Failed batches gave their in-flight slot back when they were recorded; lost ones still hold theirs
+        bulk.reserve_slots(run_id, sum(1 for start, end, _ in batches if jobs.batch_key(start, end) in job['failed_batches']))
+        signatures = [
+            ocr_bulk_batch.s(run_id, {"file_id": file_id, "job_id": job_id, "start_page": start, "end_page": end,
+                                      "path": path}, job['ocr_option'])
+            for start, end, path in batches
+        ]
+        for signature in schedule_batches(signatures, job['user_id'], BULK_QUEUE):
+            signature.apply_async()
+    else:
+        dispatch_job_batches(job_id, file_id, batches, job['ocr_option'], job['page_range'],
+                             job['user_id'], job['queue'] or BULK_QUEUE)
+    return job
+
+
+@celery.task
+def resume_file_ocr(file_id, ocr_option="basic"):
+    """Resume the file's last job from its checkpoints, or start a fresh job if there is none left."""
+    job_id = jobs.get_file_job(file_id)
+    with session_scope() as session:
+        file_entry = session.query(File).filter_by(id=file_id).first()
+        if not file_entry:
+            return
+        file_entry.status = 'Processing'
+    if job_id is None or resume_job(job_id) is None:
+        ocr_pdf_file.delay(file_id, ocr_option)
+
+
+# How often the reaper looks for stalled jobs, and how long a file may sit in
+# 'Processing' without any job before it is given up on
+REAPER_INTERVAL = int(os.getenv('OCR_REAPER_INTERVAL', '300'))
+ORPHAN_SECONDS = int(os.getenv('OCR_JOB_ORPHAN_SECONDS', str(6 * 3600)))
+REAPER_LOCK_KEY = "ocr:jobs:reaper_lock"
+
+
+@celery.task
+def reap_stalled_jobs():
+    """
+    Re-dispatch batches and merges that started (or, for a merge, were due)
+    more than OCR_JOB_STALL_SECONDS ago without finishing or being redelivered,
+    merge as failed the jobs that used up their resumes, and fail files left
+    'Processing' without any job (e.g. ocr_pdf_file died before creating one).
+    """
+    # Only one reaper at a time, even with several beat schedulers
+    if not get_redis().set(REAPER_LOCK_KEY, 1, nx=True, ex=max(REAPER_INTERVAL - 1, 1)):
+        return
+
+    for job_id, stalled in jobs.stalled_work().items():
+        job = jobs.load_job(job_id)
+        if job is None:
+            jobs.clear_running(job_id, list(stalled))
+        elif jobs.MERGE in stalled:
+            print(f"Merge of job {job_id} for file {job['file_id']} stalled, queueing it again")
+            queue_merge(job_id, job['file_id'], job['run_id'])
+        elif job['resumes'] >= jobs.JOB_MAX_RESUMES:
+            print(f"Job {job_id} for file {job['file_id']} stalled after {job['resumes']} resumes, merging as failed")
+            jobs.clear_running(job_id, list(stalled))
+            queue_merge(job_id, job['file_id'], job['run_id'])
+        else:
+            print(f"Job {job_id} for file {job['file_id']}: batches {', '.join(sorted(stalled))} stalled, "
+                  f"dispatching them again")
+            # Restart the clock, so the new deliveries get a full stall window of their own
+            jobs.mark_running(job_id, stalled)
+            resume_job(job_id, stalled)
+
+    cutoff = datetime.utcnow() - timedelta(seconds=ORPHAN_SECONDS)
+    with session_scope() as session:
+        stale_files = session.query(File).filter(File.status == 'Processing', File.updated_at < cutoff).all()
+        for file_entry in stale_files:
+            job_id = jobs.get_file_job(file_entry.id)
+            if job_id is not None and jobs.load_job(job_id) is not None:
+                continue
+            print(f"File {file_entry.id} has been processing since {file_entry.updated_at} without a job, failing it")
+            file_entry.status = 'Failed'
+            finish_progress(file_entry.id, 'Failed')
@@ -0,0 +1,77 @@
+import os
+import json
+import logging
+import aiofiles
+from aiofiles import os as async_os
+from app.redis_client import get_async_redis
+
+logger = logging.getLogger(__name__)
+
+# Resumable uploads: every chunk is written straight to its offset in the final
+# file, and the set of received chunk indexes is kept in Redis so a client can
+# ask which chunks are still missing and resume after a dropped connection.
+# An upload id is bound to the file it was first used for; chunks sent under
+# it for another target are refused rather than written into the wrong file.
+UPLOAD_KEY = "ocr:upload:{upload_id}"
+UPLOAD_TTL = 24 * 3600
+
+
+async def write_chunk(upload_id, target_path, chunk_index, total_chunks, chunk_size, body, total_size=None):
+    """
+    Write one chunk at chunk_index * chunk_size in target_path, creating and
+    preallocating the file on first use. Returns (received_chunks, completed)
+    where completed is True for exactly one request: the one that delivered
+    the last missing chunk, or None if upload_id belongs to a different file.
+    """
+    redis_client = get_async_redis()
+    key = UPLOAD_KEY.format(upload_id=upload_id)
+    meta = json.dumps({"target_path": target_path, "total_chunks": total_chunks, "total_size": total_size})
+    if not await redis_client.hsetnx(key, "meta", meta):
+        stored = json.loads(await redis_client.hget(key, "meta"))
+        if stored["target_path"] != target_path or stored["total_chunks"] != total_chunks:
+            logger.warning(f"Refused a chunk of upload {upload_id} for {target_path}, "
+                           f"it was started for {stored['target_path']}")
+            return None
+    await redis_client.expire(key, UPLOAD_TTL)
+
+    await async_os.makedirs(os.path.dirname(target_path), exist_ok=True)
+    # Append mode creates the file without truncating chunks other requests already wrote
+    async with aiofiles.open(target_path, 'ab'):
+        pass
+    if total_size and (await async_os.stat(target_path)).st_size < total_size:
+        async with aiofiles.open(target_path, 'r+b') as target_file:
+            await target_file.truncate(total_size)
+
+    async with aiofiles.open(target_path, 'r+b') as target_file:
+        await target_file.seek(chunk_index * chunk_size)
+        await target_file.write(body)
+
+    received_key = f"{key}:chunks"
+    pipeline = redis_client.pipeline()
+    pipeline.sadd(received_key, chunk_index)
+    pipeline.expire(received_key, UPLOAD_TTL)
+    pipeline.scard(received_key)
+    _, _, received_chunks = await pipeline.execute()
+
+    completed = False
+    if received_chunks >= total_chunks:
+        # Several parallel requests can see the final count; only one may finish the upload
+        completed = bool(await redis_client.hsetnx(key, "completed", 1))
+    return received_chunks, completed
+
+
+async def get_upload_status(upload_id):
+    """Return the received chunk indexes and completion state, or None for an unknown upload."""
+    redis_client = get_async_redis()
+    key = UPLOAD_KEY.format(upload_id=upload_id)
+    upload = await redis_client.hgetall(key)
+    if not upload:
+        return None
+    meta = json.loads(upload[b"meta"])
+    received = await redis_client.smembers(f"{key}:chunks")
+    return {
+        "upload_id": upload_id,
+        "total_chunks": meta["total_chunks"],
+        "received_chunks": sorted(int(index) for index in received),
+        "completed": b"completed" in upload,
+    }
@@ -1,5 +1,9 @@
+import io
 import os
+import math
+import tempfile
 import subprocess
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
 from PyPDF2 import PdfReader, PdfWriter
 try:
@@ -13,10 +17,12 @@ from config import Config
 import shutil
 import logging
 import fitz
-import pandas as pd
-import glob
+import pikepdf
 import gc
 from app.models import File
+from app.page_cache import get_page_cache
+from app.cpu_budget import claim_cpus
+from app.instrumentation import span
 from datetime import datetime
 
 # Import the User model from the models.py file
@@ -54,12 +60,38 @@ def get_user_by_email(session, email):
     return session.query(User).filter_by(email=email).first()
 
 
+# Engine options for each OCR mode. They are part of the page cache key, so
+# changing them invalidates previously cached pages.
+OCRMYPDF_OPTIONS = ['--optimize', '1', '--force-ocr', '--rotate-pages']
+TESSERACT_OPTIONS = ['--oem', '1', '--psm', '3']
+
+# How the advanced mode rasterises pages: 'pymupdf' renders in memory and pipes
+# the image to Tesseract, 'imagemagick' shells out to magick and goes via disk.
+OCR_RASTER_BACKEND = os.getenv('OCR_RASTER_BACKEND', 'pymupdf').lower()
+
+# Lookup table that thresholds 8-bit grayscale samples to pure black/white
+BINARIZE_TABLE = bytes(0 if value < 128 else 255 for value in range(256))
+
+
+def ocr_engine_settings(ocr_option):
+    """Describe the engine configuration used for ocr_option."""
+    if ocr_option.lower() == "advanced":
+        return f"advanced:{OCR_RASTER_BACKEND}:{' '.join(TESSERACT_OPTIONS)}"
+    return f"basic:{' '.join(OCRMYPDF_OPTIONS)}"
+
+
 class PDFManipulator:
 
-    def __init__(self, input_pdf_path, outcome_pdf_path, file_id):
+    def __init__(self, input_pdf_path, outcome_pdf_path, file_id, cpus=None):
         self.input_pdf_path = input_pdf_path
         self.outcome_pdf_path = outcome_pdf_path
         self.file_id = file_id
+        # Cores this batch may use; the engine is given exactly this many workers
+        self.cpus = cpus or get_ocr_pool_size()
+
+    def engine_env(self):
+        """Environment for engine subprocesses: one OpenMP thread per Tesseract process."""
+        return {**os.environ, 'OMP_THREAD_LIMIT': '1'}
 
     def remove_signature(self):
         # Removing signature from the PDF
@@ -94,8 +126,8 @@ class PDFManipulator:
 
     def apply_ocr(self, ocr_option="basic"):
         try:
-            self.update_status('Processing')  # Set status to processing
-            
+            # The file is already 'Processing'; only merge_ocr_batches marks it 'Processed'
+
             # Ensure that the signature is removed first
             self.remove_signature()
 
@@ -103,57 +135,40 @@ class PDFManipulator:
                 # Basic OCR using ocrmypdf
                 cmd = [
                     'ocrmypdf',
-                    '--optimize', '1',
-                    '--force-ocr',
-                    '--rotate-pages',
+                    *OCRMYPDF_OPTIONS,
+                    '--jobs', str(self.cpus),
                     self.outcome_pdf_path,  # Input (unsigned PDF)
                     self.outcome_pdf_path  # Output (OCR applied)
                 ]
                 print(f"Running command: {' '.join(cmd)}")
                 # subprocess.run(cmd, check=True)
-                subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+                subprocess.run(cmd, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.engine_env())
 
             elif ocr_option.lower() == "advanced":
-                # Advanced OCR using Tesseract via ImageMagick and PyPDF2
-
-                # Step 1: Convert PDF to images
-                output_image_pattern = self.input_pdf_path.replace('.pdf', '_page_%d.png')
-                cmd_convert = [
-                    'magick',  
-                    '-density', '300',  # High DPI for better OCR accuracy
-                    self.input_pdf_path,
-                    output_image_pattern
-                ]
-                print(f"Running ImageMagick command: {' '.join(cmd_convert)}")
-                subprocess.run(cmd_convert, check=True)
-
-                # Step 2: Apply OCR to images
-                ocr_output_files = []
-                for image_file in sorted(glob.glob(output_image_pattern.replace('%d', '*'))):
-                    ocr_output_pdf = image_file.replace('.png', '.pdf')
-                    cmd_ocr = [
-                        'tesseract',
-                        image_file,
-                        ocr_output_pdf.replace('.pdf', ''),  # Output file name without extension
-                        '--oem', '1',  # Use the LSTM OCR Engine
-                        '--psm', '3',  # Page segmentation mode
-                        'pdf'
-                    ]
-                    print(f"Running Tesseract OCR on: {image_file}")
-                    subprocess.run(cmd_ocr, check=True)
-                    ocr_output_files.append(ocr_output_pdf)
-
-                # Step 3: Merge OCR'ed PDFs into a single output PDF
-                if ocr_output_files:
-                    self.merge_ocr_pdfs(ocr_output_files)
+                # Advanced OCR: render each page and hand it to a bounded pool of
+                # Tesseract processes as soon as it is ready. Page images and
+                # per-page PDFs that go via disk live in work_dir, which is
+                # removed once the pages are merged.
+                pages_parent = os.path.dirname(self.outcome_pdf_path) or None
+                with tempfile.TemporaryDirectory(prefix='.pages-', dir=pages_parent) as work_dir:
+                    with ThreadPoolExecutor(max_workers=self.cpus) as pool:
+                        futures = [
+                            pool.submit(self.ocr_page_image, image)
+                            for image in self.render_page_images(work_dir)
+                        ]
+                        # Futures are in page order, so the merge keeps the original order
+                        ocr_output_files = [future.result() for future in futures]
+
+                    # Merge OCR'ed PDFs into a single output PDF
+                    if ocr_output_files:
+                        self.merge_ocr_pdfs(ocr_output_files)
 
             else:
                 raise ValueError("Invalid OCR option provided.")
 
             print(f"OCR applied successfully using {ocr_option}. Output saved to {self.outcome_pdf_path}")
             
-            # Once all processing is done, update the file status
-            self.update_status('Processed')  # Mark as processed
+            return True
 
         except subprocess.CalledProcessError as e:
             print(f"Error executing command: {e.cmd}")
@@ -161,17 +176,84 @@ class PDFManipulator:
             print(f"Error output: {e.stderr.decode()}")
             print(f"Standard output: {e.stdout.decode()}")
             self.update_status('Failed')
-            
+            return False
+
         except Exception as e:
             print(f"Error processing {self.input_pdf_path} with {ocr_option} OCR: {e}")
+            return False
         finally:
             gc.collect()
 
+    def render_page_images(self, work_dir):
+        """
+        Yield one image per page as soon as it is rendered: PNG bytes for the
+        PyMuPDF backend, a PNG file path in work_dir for the ImageMagick backend.
+        """
+        if OCR_RASTER_BACKEND == 'imagemagick':
+            yield from self.render_page_images_with_magick(work_dir)
+        else:
+            yield from self.render_page_images_with_fitz()
+
+    def render_page_images_with_fitz(self):
+        """Render pages in memory, binarising pure black/white scans and using grayscale otherwise."""
+        with fitz.open(self.input_pdf_path) as pdf_document:
+            for page in pdf_document:
+                images = page.get_images(full=True)
+                bilevel = bool(images) and all(image[4] == 1 for image in images)
+                pixmap = page.get_pixmap(dpi=DEFAULT_OCR_DPI, colorspace=fitz.csGRAY, alpha=False)
+                if bilevel:
+                    samples = pixmap.samples.translate(BINARIZE_TABLE)
+                    pixmap = fitz.Pixmap(fitz.csGRAY, pixmap.width, pixmap.height, samples, False)
+                    pixmap.set_dpi(DEFAULT_OCR_DPI, DEFAULT_OCR_DPI)
+                yield pixmap.tobytes("png")
+
+    def render_page_images_with_magick(self, work_dir):
+        """
+        Render every page of the batch to a 300 DPI PNG in work_dir with a
+        single ImageMagick (and so a single Ghostscript) run.
+        """
+        cmd_convert = [
+            'magick',
+            '-density', '300',  # High DPI for better OCR accuracy
+            self.input_pdf_path,
+            os.path.join(work_dir, 'page_%05d.png')
+        ]
+        print(f"Running ImageMagick command: {' '.join(cmd_convert)}")
+        subprocess.run(cmd_convert, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        # Zero-padded scene numbers sort in page order
+        for image_name in sorted(name for name in os.listdir(work_dir) if name.endswith('.png')):
+            yield os.path.join(work_dir, image_name)
+
+    def ocr_page_image(self, image):
+        """
+        Run Tesseract on a single page image. In-memory images are piped through
+        stdin/stdout and the PDF bytes are returned; image files produce a PDF
+        file next to them (inside the caller's work_dir) and its path is returned.
+        """
+        if isinstance(image, bytes):
+            cmd_ocr = ['tesseract', 'stdin', 'stdout', *TESSERACT_OPTIONS, 'pdf']
+            result = subprocess.run(cmd_ocr, input=image, check=True, stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE, env=self.engine_env())
+            return result.stdout
+
+        ocr_output_pdf = image.replace('.png', '.pdf')
+        cmd_ocr = [
+            'tesseract',
+            image,
+            ocr_output_pdf.replace('.pdf', ''),  # Output file name without extension
+            *TESSERACT_OPTIONS,  # LSTM engine, automatic page segmentation
+            'pdf'
+        ]
+        print(f"Running Tesseract OCR on: {image}")
+        subprocess.run(cmd_ocr, check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE, env=self.engine_env())
+        return ocr_output_pdf
+
     def merge_ocr_pdfs(self, ocr_pdf_files):
         try:
             merger = PdfMerger()
             for pdf_file in ocr_pdf_files:
-                merger.append(pdf_file)
+                # Pages OCR'd in memory arrive as PDF bytes rather than file paths
+                merger.append(io.BytesIO(pdf_file) if isinstance(pdf_file, bytes) else pdf_file)
 
             with open(self.outcome_pdf_path, 'wb') as f_out:
                 merger.write(f_out)
@@ -180,65 +262,202 @@ class PDFManipulator:
             print(f"Error merging OCR'ed PDFs: {e}")
 
 
-def extract_bookmarks_to_dataframe(input_pdf):
+# Bookmarks travel through Celery as a compact TOC: a list of
+# [level, title, page] entries, the shape fitz.get_toc() uses but with 0-indexed
+# pages. It serialises to plain JSON arrays, so even tens of thousands of
+# entries stay small in the job manifest.
+
+
+def extract_bookmarks(input_pdf):
     """
-    Extract bookmarks from the input PDF and store them in a pandas DataFrame.
+    Extract the bookmarks of the input PDF as a compact TOC of
+    [level, title, page] entries with 0-indexed pages.
     """
-    bookmarks = []
-    pdf_document = fitz.open(input_pdf)
+    with fitz.open(input_pdf) as pdf_document:
+        # simple=True skips reading each outline item's link details
+        toc = [[level, title, page_num - 1] for level, title, page_num in pdf_document.get_toc(simple=True)]
+    print(f"Extracted {len(toc)} bookmarks from {input_pdf}")
+    return toc
+
+
+# Batch planning: a page's cost is its rasterised pixel count expressed in
+# "standard pages" (US Letter at 300 DPI), which tracks Tesseract time far
+# better than a flat page count.
+DEFAULT_OCR_DPI = 300
+STANDARD_PAGE_PIXELS = (8.5 * DEFAULT_OCR_DPI) * (11 * DEFAULT_OCR_DPI)
+MAX_BATCH_COST = float(os.getenv('OCR_MAX_BATCH_COST', '25'))
+MIN_BATCH_PAGES = int(os.getenv('OCR_MIN_BATCH_PAGES', '1'))
+# A batch costing less than this fraction of the target is folded into a
+# neighbour; skewed files otherwise end in a tail of near-empty tasks.
+MIN_BATCH_COST_FRACTION = float(os.getenv('OCR_MIN_BATCH_COST_FRACTION', '0.25'))
+
+
+def get_worker_concurrency():
+    """Return the number of OCR tasks the Celery workers run at once."""
+    try:
+        concurrency = int(os.getenv('CELERY_WORKER_CONCURRENCY') or 0)
+    except ValueError:
+        concurrency = 0
+    return concurrency if concurrency > 0 else (os.cpu_count() or 1)
 
-    # Get all the bookmarks (table of contents) from the PDF
-    outlines = pdf_document.get_toc()
 
-    # Extract each bookmark's level, title, and page number
-    for outline in outlines:
-        level, title, page_num = outline
-        bookmarks.append({"bookmark": title, "line": level, "page": page_num - 1})  # Page is 0-indexed in PyMuPDF
-        print(f"Extracted Bookmark: '{title}' on Page: {page_num}")
+def get_ocr_pool_size():
+    """
+    Return how many engine processes a single batch may run in parallel when
+    the shared CPU budget is unavailable. Defaults to this worker's static share
+    of the cores, so concurrent batches do not oversubscribe the machine.
+    """
+    try:
+        pool_size = int(os.getenv('OCR_TESSERACT_POOL_SIZE') or 0)
+    except ValueError:
+        pool_size = 0
+    if pool_size > 0:
+        return pool_size
+    return max(1, (os.cpu_count() or 1) // get_worker_concurrency())
 
-    # Convert the bookmarks list to a pandas DataFrame
-    df_bookmarks = pd.DataFrame(bookmarks)
-    pdf_document.close()
-    print(df_bookmarks)
-    return df_bookmarks
 
+def estimate_page_costs(file_path):
+    """
+    Estimate the relative OCR cost of every page using the image sizes and
+    resolutions PyMuPDF reports. Pages without images are costed as if they
+    were rasterised at DEFAULT_OCR_DPI.
+    """
+    costs = []
+    pdf_document = fitz.open(file_path)
+    try:
+        for page in pdf_document:
+            width_in = page.rect.width / 72
+            height_in = page.rect.height / 72
+            dpi = DEFAULT_OCR_DPI
+            for image in page.get_image_info():
+                dpi = max(dpi, image.get('xres') or 0, image.get('yres') or 0)
+            costs.append(width_in * height_in * dpi * dpi / STANDARD_PAGE_PIXELS)
+    finally:
+        pdf_document.close()
+    return costs
 
-def reattach_bookmarks_from_dataframe(output_pdf, df_bookmarks, start_page, end_page):
+
+def plan_page_batches(page_costs, worker_concurrency=None):
+    """
+    Split the pages into contiguous batches of roughly equal OCR cost.
+
+    There is at least one batch per worker (so small files still use every
+    core) and no batch is planned above MAX_BATCH_COST (so large files do not
+    turn into hundreds of tiny tasks). Batches that end up below
+    MIN_BATCH_PAGES or the minimum cost are merged into a neighbour, so a
+    skewed file gets fewer batches rather than slivers. Returns a JSON
+    serialisable plan whose 'batches' entries hold 1-indexed, inclusive
+    start/end pages.
+    """
+    total_pages = len(page_costs)
+    worker_concurrency = worker_concurrency or get_worker_concurrency()
+    total_cost = sum(page_costs)
+    max_batches = max(1, total_pages // max(MIN_BATCH_PAGES, 1))
+
+    batch_count = max(math.ceil(total_cost / MAX_BATCH_COST), worker_concurrency)
+    if batch_count > worker_concurrency:
+        # Round up to whole waves so the last wave does not run half empty
+        batch_count = math.ceil(batch_count / worker_concurrency) * worker_concurrency
+    batch_count = max(1, min(batch_count, max_batches))
+    target_cost = total_cost / batch_count if batch_count else 0
+
+    batches = []
+    start = 0
+    cumulative = 0.0
+
+    def close_batch(end):
+        batches.append({
+            "start_page": start + 1,
+            "end_page": end + 1,
+            "cost": round(sum(page_costs[start:end + 1]), 3),
+        })
+
+    for page in range(total_pages):
+        previous = cumulative
+        cumulative += page_costs[page]
+        batches_left = batch_count - len(batches) - 1
+        if batches_left <= 0:
+            continue
+        boundary = (len(batches) + 1) * target_cost
+        pages_left = total_pages - page - 1
+        if pages_left <= batches_left * MIN_BATCH_PAGES:
+            # Just enough pages remain to fill the remaining batches
+            close_batch(page)
+            start = page + 1
+        elif cumulative >= boundary:
+            # Cut on whichever side of this page lands closer to the boundary
+            if cumulative - boundary > boundary - previous and page - start >= MIN_BATCH_PAGES:
+                close_batch(page - 1)
+                start = page
+            elif page - start + 1 >= MIN_BATCH_PAGES:
+                close_batch(page)
+                start = page + 1
+    if start < total_pages:
+        close_batch(total_pages - 1)
+    merge_small_batches(batches, page_costs, target_cost * MIN_BATCH_COST_FRACTION)
+
+    return {
+        "total_pages": total_pages,
+        "total_cost": round(total_cost, 3),
+        "worker_concurrency": worker_concurrency,
+        "target_cost": round(target_cost, 3),
+        "batch_count": len(batches),
+        "batches": batches,
+    }
+
+
+def merge_small_batches(batches, page_costs, min_cost):
+    """
+    Fold every batch below MIN_BATCH_PAGES or min_cost into its cheaper
+    neighbour, in place, until none is left (or only one batch remains).
     """
-    Reattach bookmarks to the extracted pages using the pandas DataFrame.
+    def is_small(batch):
+        pages = batch["end_page"] - batch["start_page"] + 1
+        return pages < MIN_BATCH_PAGES or batch["cost"] < min_cost
+
+    while len(batches) > 1:
+        small = [i for i, batch in enumerate(batches) if is_small(batch)]
+        if not small:
+            break
+        # Cheapest first; a merge that is still too small is caught next pass
+        index = min(small, key=lambda i: batches[i]["cost"])
+        neighbours = [i for i in (index - 1, index + 1) if 0 <= i < len(batches)]
+        other = min(neighbours, key=lambda i: batches[i]["cost"])
+        first, second = sorted((index, other))
+        start_page = batches[first]["start_page"]
+        end_page = batches[second]["end_page"]
+        batches[first:second + 1] = [{
+            "start_page": start_page,
+            "end_page": end_page,
+            "cost": round(sum(page_costs[start_page - 1:end_page]), 3),
+        }]
+
+
+# 'ranges' hands workers page ranges of the source document and only the pages
+# that actually go to the engine are ever written out; 'files' writes a
+# standalone PDF per batch up front.
+OCR_BURST_MODE = os.getenv('OCR_BURST_MODE', 'ranges').lower()
+
+
+def burst_pdf(file_path, mode=None):
     """
-    pdf_document = fitz.open(output_pdf)
-    toc = []  # This will hold the new Table of Contents (TOC) items
-
-    # Iterate over the bookmarks and add them back if they are within the page range
-    for _, row in df_bookmarks.iterrows():
-        if start_page - 1 <= row['page'] < end_page:
-            # Adjust the page number for the new document
-            adjusted_page_num = row['page'] - (start_page - 1) + 1
-            # Append the bookmark to the new TOC list
-            toc.append([row['line'], row['bookmark'], adjusted_page_num])
-            print(f"Reattached Bookmark: '{row['bookmark']}' on New Page: {adjusted_page_num}")
-
-    # Set the TOC back to the new document
-    pdf_document.set_toc(toc)
-    
-    # Create a new file to hold the updated PDF
-    output_pdf = output_pdf.replace("_OCRed.pdf", "_OCRed_with_bookmarks.pdf")
-
-    # Save the updated PDF without incremental saving (overwrite the original file)
-    pdf_document.save(output_pdf, incremental=False)
-    pdf_document.close()
-    print(f"Final PDF with bookmarks saved to {output_pdf}")
-    
-    
-def burst_pdf(file_path):
-    logger.debug(f"Starting burst_pdf with file_path: {file_path}")
+    Split the PDF into batches following plan_page_batches.
+    Returns (burst_files, plan) where burst_files holds (start, end, path)
+    tuples. In 'ranges' mode every path is the source document itself.
+    """
+    mode = mode or OCR_BURST_MODE
+    logger.debug(f"Starting burst_pdf with file_path: {file_path} in {mode} mode")
     try:
-        pdf_reader = PdfReader(open(file_path, 'rb'))
-        total_pages = len(pdf_reader.pages)
-        logger.debug(f"Total pages in PDF: {total_pages}")
-        
-        batch_size = 10  # Number of pages per batch
+        try:
+            page_costs = estimate_page_costs(file_path)
+        except Exception as e:
+            logger.error(f"Failed to estimate page costs for {file_path}, assuming uniform pages. Error: {e}")
+            page_costs = [1.0] * len(PdfReader(file_path).pages)
+        logger.debug(f"Total pages in PDF: {len(page_costs)}")
+        plan = plan_page_batches(page_costs)
+        plan['mode'] = mode
+        logger.debug(f"Batch plan for {file_path}: {plan}")
+
         parent_dir = os.path.dirname(file_path)
         tmp_dir = os.path.join(parent_dir, 'tmp')
         
@@ -248,11 +467,17 @@ def burst_pdf(file_path):
             logger.debug(f"Created tmp directory at: {tmp_dir}")
         except Exception as e:
             logger.error(f"Failed to create tmp directory: {tmp_dir}. Error: {e}")
-            return []
+            return [], plan
+
+        if mode == 'ranges':
+            # Nothing is copied here; workers extract the pages they OCR from the source
+            return [(batch['start_page'], batch['end_page'], file_path) for batch in plan['batches']], plan
 
+        pdf_reader = PdfReader(open(file_path, 'rb'))
         burst_files = []
-        for start_page in range(0, total_pages, batch_size):
-            end_page = min(start_page + batch_size, total_pages)
+        for batch in plan['batches']:
+            start_page = batch['start_page'] - 1
+            end_page = batch['end_page']
             pdf_writer = PdfWriter()
 
             # Add pages to the writer
@@ -277,43 +502,282 @@ def burst_pdf(file_path):
                 logger.error(f"Failed to write batch file {batch_file_path}. Error: {e}")
                 continue
 
-        return burst_files
+        return burst_files, plan
 
     except Exception as e:
         logger.error(f"Failed to burst PDF {file_path}. Error: {e}")
-        return []
+        return [], None
+
 
+# Save the final PDF linearized ("fast web view") so viewers can show the first
+# pages before the whole file has arrived; costs an extra pass over the output.
+LINEARIZE_OUTPUT = os.getenv('OCR_LINEARIZE_OUTPUT', '0') == '1'
 
-def merge_pdf(ocr_files, output_dir, original_file_name):
-    final_pdf_name = f"{os.path.splitext(original_file_name)[0]}_OCRed.pdf"
+
+def merge_pdf_with_bookmarks(ocr_files, toc, output_dir, original_file_name):
+    """
+    Merge the OCR'd batches and attach the bookmarks in a single pass, writing
+    the final _OCRed_with_bookmarks.pdf once. pikepdf copies page objects
+    lazily from the open batch files, so stream data is only read while the
+    output is written and peak memory does not grow with the page count.
+    Raises FileNotFoundError, writing nothing, if a batch file is missing.
+    """
+    final_pdf_name = f"{os.path.splitext(original_file_name)[0]}_OCRed_with_bookmarks.pdf"
     final_pdf_path = os.path.join(output_dir, final_pdf_name)
-    pdf_writer = PdfWriter()
+    tmp_pdf_path = f"{final_pdf_path}.tmp"
 
-    for ocr_file in ocr_files:
-        if os.path.exists(ocr_file):
-            pdf_reader = PdfReader(open(ocr_file, 'rb'))
-            for page in range(len(pdf_reader.pages)):
-                pdf_writer.add_page(pdf_reader.pages[page])
-        else:
-            print(f"Warning: {ocr_file} does not exist and will not be included in the final document.")
+    batch_pdfs = []
+    final_pdf = pikepdf.Pdf.new()
+    try:
+        for ocr_file in ocr_files:
+            if not os.path.exists(ocr_file):
+                # Never write a final document with a batch's pages missing
+                raise FileNotFoundError(f"OCR'd batch {ocr_file} does not exist")
+            batch_pdf = pikepdf.Pdf.open(ocr_file)
+            batch_pdfs.append(batch_pdf)
+            final_pdf.pages.extend(batch_pdf.pages)
+
+        # Rebuild the outline tree from the flat [level, title, page] TOC
+        total_pages = len(final_pdf.pages)
+        with final_pdf.open_outline() as outline:
+            parents = []  # Stack of (level, OutlineItem) for the current branch
+            for level, title, page in toc:
+                if not 0 <= page < total_pages:
+                    continue
+                item = pikepdf.OutlineItem(title, page)
+                while parents and parents[-1][0] >= level:
+                    parents.pop()
+                (parents[-1][1].children if parents else outline.root).append(item)
+                parents.append((level, item))
 
-    with open(final_pdf_path, 'wb') as output_file:
-        pdf_writer.write(output_file)
+        final_pdf.save(tmp_pdf_path, linearize=LINEARIZE_OUTPUT)
+    finally:
+        final_pdf.close()
+        for batch_pdf in batch_pdfs:
+            batch_pdf.close()
 
+    os.replace(tmp_pdf_path, final_pdf_path)
+    print(f"Final PDF with bookmarks saved to {final_pdf_path}")
     return final_pdf_path
 
 
-def apply_ocr_on_pdf(file_path, file_id, ocr_option="basic"):
-    output_path = file_path.replace("uploads", "ocr_output")
+# Page classification: only image-only and mixed pages are sent to the OCR
+# engine, pages with a usable embedded text layer are passed through untouched.
+# An image counts as already read when text lies over it: invisible text (an
+# earlier OCR pass, render mode 3) or visible text spanning most of it. A page
+# is mixed only when the images without text over them cover enough of it.
+PAGE_TEXT = 'text'
+PAGE_IMAGE_ONLY = 'image'
+PAGE_MIXED = 'mixed'
+MIN_TEXT_CHARS = int(os.getenv('OCR_MIN_TEXT_CHARS', '32'))
+MIXED_IMAGE_COVERAGE = float(os.getenv('OCR_MIXED_IMAGE_COVERAGE', '0.5'))
+
+
+def image_has_text(image_rect, text_rects, invisible_rects):
+    """True if invisible text lies on the image or the visible text on it spans most of it."""
+    if any(image_rect.intersects(rect) for rect in invisible_rects):
+        return True
+    text_extent = None
+    for rect in text_rects:
+        if image_rect.intersects(rect):
+            clipped = rect & image_rect
+            text_extent = clipped if text_extent is None else text_extent | clipped
+    return text_extent is not None and abs(text_extent) >= MIXED_IMAGE_COVERAGE * abs(image_rect)
+
+
+def classify_pages(file_path, pages=None):
+    """
+    Classify every page (or every 0-indexed page in pages) as PAGE_TEXT,
+    PAGE_IMAGE_ONLY or PAGE_MIXED from its extractable text and the share of
+    the page covered by images that have no text over them.
+    """
+    page_kinds = []
+    pdf_document = fitz.open(file_path)
+    try:
+        if pages is None:
+            pages = range(pdf_document.page_count)
+        for page_number in pages:
+            page = pdf_document[page_number]
+            text = page.get_text("text").strip()
+            # Text made of unmapped glyphs is not usable, treat it as missing
+            usable_chars = len(text) - text.count('\ufffd')
+            if usable_chars < MIN_TEXT_CHARS:
+                page_kinds.append(PAGE_IMAGE_ONLY)
+                continue
+
+            page_area = abs(page.rect) or 1
+            image_rects = [fitz.Rect(image['bbox']) & page.rect for image in page.get_image_info()]
+            if sum(abs(rect) for rect in image_rects) / page_area < MIXED_IMAGE_COVERAGE:
+                page_kinds.append(PAGE_TEXT)
+                continue
+
+            # Only pages with large images pay for the text positions
+            text_rects = [fitz.Rect(line['bbox']) for block in page.get_text("dict")["blocks"]
+                          if block['type'] == 0 for line in block['lines']]
+            invisible_rects = [fitz.Rect(text_span['bbox']) for text_span in page.get_texttrace()
+                               if text_span['type'] == 3]
+            unread_area = sum(abs(rect) for rect in image_rects
+                              if not image_has_text(rect, text_rects, invisible_rects))
+            page_kinds.append(PAGE_MIXED if unread_area / page_area >= MIXED_IMAGE_COVERAGE else PAGE_TEXT)
+    finally:
+        pdf_document.close()
+    return page_kinds
+
+
+# OCR'd batches mirror their source's path under OCR_OUTPUT_ROOT: files under
+# OCR_UPLOAD_ROOT keep their path relative to it, files anywhere else (a bulk
+# folder) keep their absolute path below an 'external' directory. An output
+# path is never the input path, whatever the folder is called.
+OCR_UPLOAD_ROOT = os.path.abspath(os.getenv('OCR_UPLOAD_ROOT', 'uploads'))
+OCR_OUTPUT_ROOT = os.path.abspath(os.getenv('OCR_OUTPUT_ROOT', 'ocr_output'))
+
+
+def batch_output_path(batch_path):
+    """Where the OCR'd copy of batch_path is written."""
+    source = os.path.abspath(batch_path)
+    if source.startswith(OCR_UPLOAD_ROOT + os.sep):
+        return os.path.join(OCR_OUTPUT_ROOT, os.path.relpath(source, OCR_UPLOAD_ROOT))
+    return os.path.join(OCR_OUTPUT_ROOT, 'external', source.lstrip(os.sep))
+
+
+def apply_ocr_on_pdf(file_path, file_id, ocr_option="basic", page_range=None):
+    """
+    OCR a batch, passing text-bearing pages through and reusing cached pages
+    where possible. The batch is either the whole of file_path or, when
+    page_range=(start, end) is given, those 1-indexed pages of the source.
+    Returns (output_path, page_stats) with the batch's skipped pages and cache
+    hit/miss counts.
+    """
+    batch_path = file_path
+    if page_range:
+        start_page, end_page = page_range
+        batch_name = f"{os.path.splitext(os.path.basename(file_path))[0]}_pages_{start_page}_to_{end_page}.pdf"
+        batch_path = os.path.join(os.path.dirname(file_path), 'tmp', batch_name)
+    output_path = batch_output_path(batch_path)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
+    # Intermediates go to a directory of this delivery's own next to output_path and
+    # only the finished batch is renamed into place, so a batch killed halfway never
+    # leaves a truncated output and two deliveries of one batch never share files
+    work_dir = tempfile.mkdtemp(prefix='.ocr-', dir=os.path.dirname(output_path))
+    try:
+        return ocr_batch_in(work_dir, file_path, batch_path, output_path, file_id, ocr_option, page_range)
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
 
-    # Create a PDFManipulator instance with the file_id argument
-    manipulator = PDFManipulator(file_path, output_path, file_id)
 
-    # Apply OCR based on the selected option
-    manipulator.apply_ocr(ocr_option=ocr_option)
+def ocr_batch_in(work_dir, file_path, batch_path, output_path, file_id, ocr_option, page_range):
+    """The body of apply_ocr_on_pdf, writing every intermediate file under work_dir."""
+    partial_output_path = os.path.join(work_dir, 'batch.pdf')
+    page_stats = {"skipped": 0, "hits": 0, "misses": 0}
+    cache = get_page_cache()
+    batch = f"{page_range[0]}-{page_range[1]}" if page_range else os.path.basename(file_path)
 
-    return output_path
+    try:
+        with span("classify_pages", file_id, batch):
+            with fitz.open(file_path) as pdf_document:
+                page_count = pdf_document.page_count
+            pages = list(range(page_range[0] - 1, page_range[1])) if page_range else list(range(page_count))
+            page_kinds = classify_pages(file_path, pages)
+            if cache is not None:
+                page_keys = cache.page_keys(file_path, ocr_engine_settings(ocr_option), pages)
+            else:
+                page_keys = [None] * len(pages)
+    except Exception as e:
+        if page_range:
+            logger.error(f"Failed to inspect pages {page_range} of {file_path}. Error: {e}")
+            raise
+        logger.error(f"Failed to inspect pages of {file_path}, OCRing the whole batch. Error: {e}")
+        with span("ocr_engine", file_id, batch), claim_cpus(os.cpu_count() or 1) as cpus:
+            manipulator = PDFManipulator(file_path, partial_output_path, file_id, cpus=cpus)
+            if not manipulator.apply_ocr(ocr_option=ocr_option):
+                raise RuntimeError(f"OCR failed for {file_path}")
+        os.replace(partial_output_path, output_path)
+        return output_path, page_stats
+
+    # Decide where each output page comes from: the original file, the cache or the OCR engine
+    page_sources = []
+    for page, kind, key in zip(pages, page_kinds, page_keys):
+        cached = cache.get(key) if key is not None and kind != PAGE_TEXT else None
+        if kind == PAGE_TEXT:
+            page_sources.append((page, 'original', None))
+            page_stats["skipped"] += 1
+        elif cached is not None:
+            page_sources.append((page, 'cache', cached))
+            page_stats["hits"] += 1
+        else:
+            page_sources.append((page, 'ocr', None))
+            page_stats["misses"] += 1
+    ocr_pages = [page for page, source, _ in page_sources if source == 'ocr']
+    logger.debug(f"Pages of {batch_path}: {page_stats['skipped']} skipped, "
+                 f"{page_stats['hits']} cache hits, {page_stats['misses']} to OCR")
+
+    ocr_document = None
+    ocr_input_path = None
+    ocr_output_path = None
+    if ocr_pages:
+        if len(ocr_pages) == page_count:
+            # The whole file goes through the engine, no need to copy it
+            ocr_input_path = file_path
+        else:
+            # Only the pages sent to the engine are written out, and only for as long as it runs
+            ocr_input_path = os.path.join(work_dir, 'ocr_pages.pdf')
+            source_document = fitz.open(file_path)
+            source_document.select(ocr_pages)
+            source_document.save(ocr_input_path, garbage=3, deflate=True)
+            source_document.close()
+        ocr_output_path = os.path.join(work_dir, 'ocr_output.pdf')
+        if ocr_input_path == file_path:
+            ocr_output_path = partial_output_path
+
+        # Size the engine's worker pool from the cores currently free on this host
+        with span("ocr_engine", file_id, batch), claim_cpus(len(ocr_pages)) as cpus:
+            manipulator = PDFManipulator(ocr_input_path, ocr_output_path, file_id, cpus=cpus)
+            ocr_succeeded = manipulator.apply_ocr(ocr_option=ocr_option)
+        if ocr_input_path != file_path:
+            os.remove(ocr_input_path)
+        if not ocr_succeeded:
+            raise RuntimeError(f"OCR failed for {batch_path}")
+
+        ocr_document = fitz.open(ocr_output_path)
+        if cache is not None:
+            if ocr_document.page_count == len(ocr_pages):
+                keys_by_page = dict(zip(pages, page_keys))
+                for index, page in enumerate(ocr_pages):
+                    cache.put(keys_by_page[page], ocr_document, index)
+                cache.evict()
+            else:
+                logger.error(f"OCR output {ocr_output_path} has {ocr_document.page_count} pages, "
+                             f"expected {len(ocr_pages)}; not caching it")
+
+        if ocr_input_path == file_path:
+            # Every page went through the engine, its output already is the batch output
+            ocr_document.close()
+            os.replace(ocr_output_path, output_path)
+            return output_path, page_stats
+
+    # Reassemble the batch from original, cached and freshly OCR'd pages in page order
+    with span("reassemble", file_id, batch):
+        source_document = fitz.open(file_path)
+        output_document = fitz.open()
+        ocr_index = 0
+        for page, source, cached in page_sources:
+            if source == 'original':
+                output_document.insert_pdf(source_document, from_page=page, to_page=page)
+            elif source == 'cache':
+                with fitz.open(cached) as cached_document:
+                    output_document.insert_pdf(cached_document)
+            else:
+                output_document.insert_pdf(ocr_document, from_page=ocr_index, to_page=ocr_index)
+                ocr_index += 1
+        output_document.save(partial_output_path, garbage=3, deflate=True)
+        output_document.close()
+        source_document.close()
+        os.replace(partial_output_path, output_path)
+    if ocr_document is not None:
+        ocr_document.close()
+        os.remove(ocr_output_path)
+
+    return output_path, page_stats
 
 
 def cleanup_tmp_dir(tmp_dir):
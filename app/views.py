@@ -3,58 +3,82 @@ from sanic.exceptions import Forbidden
 from werkzeug.utils import secure_filename
 import os
 import uuid
-from app.models import File, Project, Client, User  # Assuming User model exists
-from app.utils import session_scope
-from app.tasks import ocr_pdf_page_batch, merge_ocr_batches, ocr_pdf_file
-from PyPDF2 import PdfReader
-from celery import group
-from celery.result import GroupResult
-import shutil
-import aiofiles
+from app.models import File, Project, Client, PageText, TEXT_SEARCH_CONFIG
+from app.db import async_session_scope
+# Tasks are published by name so web workers never import the OCR stack in app.tasks
+from app.celery_app import celery
+from app.progress import get_progress_async, FINISHED_STATES
+from app.uploads import write_chunk, get_upload_status
+from app.scheduling import get_queue_stats_async
+from app.instrumentation import get_metrics_text_async, get_job_timing_async
+from app.bulk import get_project_run_status_async
+from app.sessions import get_cached_user, invalidate_user
+from app.downloads import serve_file
+from app.previews import clamp_dpi, get_page_image, get_page_text
+import json
+import asyncio
 from aiofiles import os as async_os
 
 from app.models import Project, File
 from sqlalchemy.future import select
-from sqlalchemy.orm import Session
-from sqlalchemy import func
+from sqlalchemy.orm import selectinload, joinedload
+from sqlalchemy import func, distinct
+from datetime import datetime, timedelta
+import hashlib
 
 views_bp = Blueprint('views')
 
-def get_user_from_request(request):
-    user_id = request.cookies.get('user_id')
+# Start OCR as soon as an upload completes unless the client says otherwise
+OCR_AUTO_START = os.getenv('OCR_AUTO_START', '0') == '1'
+
+def to_int(value):
+    """Parse an id from a cookie, form field or URL, returning None if it is not an integer."""
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def get_user_id(request):
+    session = getattr(request.ctx, 'session', None)
+    if session and session.get('user_id'):
+        return to_int(session['user_id'])
+    return to_int(request.cookies.get('user_id'))
+
+
+async def get_user_from_request(request):
+    user_id = get_user_id(request)
     if user_id:
-        with session_scope() as session:
-            user = session.query(User).filter_by(id=user_id).first()
-            return user
+        return await get_cached_user(user_id)
     return None
 
 @views_bp.route('/', methods=['GET'])
 async def home(request):
-    user = get_user_from_request(request)
+    user = await get_user_from_request(request)
     is_authenticated = user is not None
     return request.app.ctx.jinja.render('home.html', request, user=user, is_authenticated=is_authenticated)
 
 
 @views_bp.route('/projects', methods=['GET'])
 async def projects(request):
-    user = get_user_from_request(request)
+    user = await get_user_from_request(request)
     is_authenticated = user is not None
     return request.app.ctx.jinja.render('projects.html', request, user=user, is_authenticated=is_authenticated)
 
 
 @views_bp.route('/signup', methods=['GET'])
 async def show_signup_form(request):
-    user = get_user_from_request(request)
+    user = await get_user_from_request(request)
     return request.app.ctx.jinja.render('signup.html', request, user=user)
 
 @views_bp.route('/login', methods=['GET'])
 async def show_login_form(request):
-    user = get_user_from_request(request)
+    user = await get_user_from_request(request)
     return request.app.ctx.jinja.render('login.html', request, user=user)
 
 @views_bp.route('/create_project', methods=['POST'])
 async def create_project(request):
-    user_id = request.cookies.get('user_id')
+    user_id = get_user_id(request)
     if not user_id:
         return response.json({'error': 'You must be logged in to create a project'}, status=403)
 
@@ -64,245 +88,459 @@ async def create_project(request):
     if not client_name or not project_name:
         return response.json({'error': 'Client name and project name are required'}, status=400)
 
-    with session_scope() as session:
-        client = session.query(Client).filter_by(name=client_name).first()
+    async with async_session_scope() as session:
+        result = await session.execute(select(Client).filter_by(name=client_name))
+        client = result.scalars().first()
         if not client:
             client = Client(name=client_name)
             session.add(client)
-            session.commit()
+            await session.commit()
 
         project = Project(name=project_name, client=client, user_id=user_id)
         session.add(project)
-        session.commit()
+        await session.commit()
 
         return response.json({'message': 'Project created successfully', 'project_id': project.id, 'client_id': client.id})
 
+
+MAX_PROJECTS_PER_PAGE = 200
+# updated_at is stamped before a transaction commits, so a file can become
+# visible with a timestamp older than the cursor already handed out. since=
+# polls look back this many seconds past the cursor; repeats are harmless.
+STATUS_CURSOR_OVERLAP = int(os.getenv('STATUS_CURSOR_OVERLAP', '60'))
+
+
+def serialize_file(file):
+    return {
+        "id": file.id,
+        "name": file.file_name,
+        "status": file.status,
+        "download_url": f"/download/{file.id}" if file.status == "Processed" else None,
+        "error_url": f"/error/{file.id}" if file.status == "Failed" else None,
+        "created_at": file.created_at.strftime('%Y-%m-%d %H:%M:%S')  
+    }
+
+
+def parse_since(value):
+    try:
+        return datetime.fromisoformat(value) if value else None
+    except ValueError:
+        return None
+
+
 @views_bp.route('/my_projects', methods=['GET'])
 async def my_projects(request):
-    user_id = request.cookies.get('user_id')
+    """
+    List the user's projects and files.
+
+    - no arguments: every project with its files (the original response)
+    - ?page=N&per_page=M: one page of projects, wrapped with paging info
+    - ?since=<cursor>: only files changed after the cursor, for polling
+
+    Every response carries an ETag (unchanged listings answer 304) and an
+    X-Status-Cursor header to pass as since= on the next poll.
+    """
+    user_id = get_user_id(request)
     if not user_id:
         return response.redirect('/login')
+
+    page = to_int(request.args.get('page'))
+    if page is not None:
+        page = max(page, 1)
+    per_page = max(1, min(to_int(request.args.get('per_page')) or 50, MAX_PROJECTS_PER_PAGE))
+    since = parse_since(request.args.get('since'))
     
-    with session_scope() as session:
-        projects = session.query(Project).filter_by(user_id=user_id).all()
-        project_list = []
-        for project in projects:
-            files = [
-                {
-                    "id": file.id,
-                    "name": file.file_name,
-                    "status": file.status,
-                    "download_url": f"/download/{file.id}" if file.status == "Processed" else None,
-                    "error_url": f"/error/{file.id}" if file.status == "Failed" else None,
-                    "created_at": file.created_at.strftime('%Y-%m-%d %H:%M:%S')  
-                }
-                for file in project.files
-            ]
-            project_list.append({
+    async with async_session_scope() as session:
+        # One aggregate query fingerprints everything the listing depends on. The
+        # sum of update times changes even when a late commit leaves the maximum alone
+        result = await session.execute(
+            select(func.count(distinct(Project.id)), func.count(File.id), func.max(File.updated_at),
+                   func.sum(func.extract('epoch', File.updated_at)))
+            .select_from(Project)
+            .outerjoin(File, File.project_id == Project.id)
+            .where(Project.user_id == user_id)
+        )
+        project_count, file_count, last_update, update_sum = result.one()
+        cursor = last_update.isoformat() if last_update else (since.isoformat() if since else '')
+        etag_source = f"{user_id}:{project_count}:{file_count}:{cursor}:{update_sum}:{page}:{per_page}:{since}"
+        etag = f'W/"{hashlib.sha1(etag_source.encode()).hexdigest()}"'
+        headers = {'ETag': etag, 'X-Status-Cursor': cursor, 'Cache-Control': 'no-cache'}
+        if request.headers.get('If-None-Match') == etag:
+            return response.empty(status=304, headers=headers)
+
+        if since is not None:
+            result = await session.execute(
+                select(File)
+                .join(Project, File.project_id == Project.id)
+                .where(Project.user_id == user_id,
+                       File.updated_at > since - timedelta(seconds=STATUS_CURSOR_OVERLAP))
+                .order_by(File.updated_at)
+            )
+            files = [serialize_file(file) for file in result.scalars().all()]
+            return response.json({"files": files, "cursor": cursor}, headers=headers)
+
+        # Client and files are loaded with one query each instead of two per project
+        query = (
+            select(Project)
+            .filter_by(user_id=user_id)
+            .options(joinedload(Project.client), selectinload(Project.files))
+            .order_by(Project.id)
+        )
+        if page:
+            query = query.limit(per_page).offset((page - 1) * per_page)
+        result = await session.execute(query)
+        projects = result.scalars().all()
+        project_list = [
+            {
+                "id": project.id,
                 "name": project.name,
                 "client_name": project.client.name, 
-                "files": files
-            })
-        
-        return response.json(project_list)
+                "files": [serialize_file(file) for file in project.files]
+            }
+            for project in projects
+        ]
+
+        if page:
+            return response.json({
+                "projects": project_list,
+                "page": page,
+                "per_page": per_page,
+                "total": project_count,
+            }, headers=headers)
+        return response.json(project_list, headers=headers)
 
 @views_bp.route('/ocr/<project_id>', methods=['GET'])
 async def show_ocr_page(request, project_id):
-    user = get_user_from_request(request)
-    user_id = request.cookies.get('user_id')
+    user = await get_user_from_request(request)
+    user_id = get_user_id(request)
     if not user_id:
         return response.redirect('/login')
 
-    with session_scope() as session:
-        project = session.query(Project).filter_by(id=project_id).first()
+    async with async_session_scope() as session:
+        project = await session.get(Project, to_int(project_id)) if to_int(project_id) else None
         if not project:
             return response.redirect('/')
 
     return request.app.ctx.jinja.render('ocr.html', request, project_id=project_id, user=user)
 
+def parse_upload_id(value):
+    """Return the client's upload id as a UUID string (a new one if none was sent), or None if it is malformed."""
+    if not value:
+        return str(uuid.uuid4())
+    try:
+        return str(uuid.UUID(value))
+    except ValueError:
+        return None
+
+
+async def receive_chunk(request, directory_parts):
+    """
+    Validate a chunk request and write the chunk in place into
+    uploads/<directory_parts>/<upload_id>/<file_name>. Returns
+    (error_response, upload) where upload describes the chunk and whether it
+    completed the file.
+    """
+    chunk = request.files.get('chunk')
+    chunk_index = int(request.form.get('chunk_index', 0))
+    total_chunks = int(request.form.get('total_chunks', 1))
+    chunk_size = to_int(request.form.get('chunk_size'))
+    total_size = to_int(request.form.get('total_size'))
+    file_name = secure_filename(request.form.get('file_name'))
+    upload_id = parse_upload_id(request.form.get('upload_id'))
+
+    if not file_name.lower().endswith('.pdf'):
+        return response.json({'error': 'Invalid file type. Only PDFs are allowed.'}, status=400), None
+    if chunk is None or upload_id is None or not 0 <= chunk_index < total_chunks:
+        return response.json({'error': 'Invalid chunk upload request'}, status=400), None
+    if chunk_size is None:
+        if total_chunks > 1:
+            return response.json({'error': 'chunk_size is required for chunked uploads'}, status=400), None
+        chunk_size = 0
+
+    # The final file lives in its own upload directory from the start, so it is never copied or moved
+    file_path = os.path.join('uploads', *[str(part) for part in directory_parts], upload_id, file_name)
+    written = await write_chunk(upload_id, file_path, chunk_index, total_chunks, chunk_size, chunk.body, total_size)
+    if written is None:
+        return response.json({'error': 'This upload id belongs to a different file'}, status=409), None
+    received_chunks, completed = written
+    return None, {
+        "upload_id": upload_id,
+        "file_name": file_name,
+        "file_path": file_path,
+        "chunk_index": chunk_index,
+        "total_chunks": total_chunks,
+        "received_chunks": received_chunks,
+        "completed": completed,
+    }
+
+
+def get_auto_ocr_option(request):
+    """Return the OCR option to start automatically once the upload completes, or None to wait for /start_ocr."""
+    auto_ocr = request.form.get('auto_ocr')
+    enabled = OCR_AUTO_START if auto_ocr is None else auto_ocr.lower() in ('1', 'true', 'on')
+    if not enabled:
+        return None
+    ocr_option = (request.form.get('ocr_option') or 'basic').lower()
+    return ocr_option if ocr_option in ('basic', 'advanced') else 'basic'
+
+
+async def register_uploaded_file(project_id, upload, ocr_option=None):
+    """
+    Create the File row for a completed upload and, when ocr_option is given,
+    queue its OCR straight away. Returns the file id, or None if the project
+    does not exist.
+    """
+    file_stat = await async_os.stat(upload['file_path'])
+    async with async_session_scope() as session:
+        project = await session.get(Project, project_id)
+        if not project:
+            return None
+
+        file_entry = File(
+            uuid=upload['upload_id'],
+            project_id=project_id,
+            file_name=upload['file_name'],
+            file_size=file_stat.st_size,
+            file_path=upload['file_path'],
+            status='Processing' if ocr_option else 'Not processed'
+        )
+        session.add(file_entry)
+        await session.commit()
+        file_id = file_entry.id  # Access the id while the session is still open
+
+    if ocr_option:
+        # Queue straight from the request that delivered the last chunk, no browser round-trip
+        celery.send_task('app.tasks.ocr_pdf_file', args=(file_id, ocr_option))
+    return file_id
+
+
 @views_bp.route('/upload_single_pdf', methods=['POST'])
 async def upload_single_pdf(request):
-    user_id = request.cookies.get('user_id')
-    project_id = request.form.get('project_id')
+    user_id = get_user_id(request)
+    project_id = to_int(request.form.get('project_id'))
     if not user_id or not project_id:
         raise Forbidden("You need to log in and select a project to upload files")
 
-    # Check if this is a chunked upload
-    chunk = request.files.get('chunk')
-    chunk_index = int(request.form.get('chunk_index', 0))
-    total_chunks = int(request.form.get('total_chunks', 1))
-    filename = secure_filename(request.form.get('file_name'))
-
-    if not filename.lower().endswith('.pdf'):
-        return response.json({'error': 'Invalid file type. Only PDFs are allowed.'}, status=400)
-
-    # Generate a unique UUID for this upload
-    unique_id = str(uuid.uuid4())
-
-    # Create a unique directory for the file chunks using UUID
-    directory = os.path.join('uploads', str(user_id), str(project_id), unique_id)
-    os.makedirs(directory, exist_ok=True)
-
-    # Save the current chunk
-    chunk_path = os.path.join(directory, f"{filename}.part{chunk_index}")
-    with open(chunk_path, 'wb') as f:
-        f.write(chunk.body)
-
-    # If the last chunk is received, merge all chunks
-    if chunk_index == total_chunks - 1:
-        final_file_path = os.path.join(directory, filename)
-        with open(final_file_path, 'wb') as final_file:
-            for i in range(total_chunks):
-                part_path = os.path.join(directory, f"{filename}.part{i}")
-                with open(part_path, 'rb') as part_file:
-                    final_file.write(part_file.read())
-                os.remove(part_path)  # Clean up the chunk part file
-
-        with session_scope() as session:
-            project = session.query(Project).filter_by(id=project_id).first()
-            if not project:
-                return response.json({'error': 'Project not found'}, status=404)
+    error, upload = await receive_chunk(request, [user_id, project_id])
+    if error:
+        return error
 
-            file_entry = File(
-                project_id=project_id,
-                file_name=filename,
-                file_size=os.path.getsize(final_file_path),
-                file_path=final_file_path,
-                status='Not processed'
-            )
-            session.add(file_entry)
-            session.commit()
-            file_id = file_entry.id  # Access the id while the session is still open
-
-        return response.json({'message': 'File uploaded and merged successfully', 'file_id': file_id})
+    # Once every chunk has landed the file is already assembled in place
+    if upload['completed']:
+        file_id = await register_uploaded_file(project_id, upload, get_auto_ocr_option(request))
+        if file_id is None:
+            return response.json({'error': 'Project not found'}, status=404)
+        return response.json({'message': 'File uploaded and merged successfully', 'file_id': file_id,
+                              'upload_id': upload['upload_id'], 'ocr_started': get_auto_ocr_option(request) is not None})
 
-    return response.json({'message': f'Chunk {chunk_index + 1}/{total_chunks} uploaded successfully'})
+    return response.json({'message': f"Chunk {upload['chunk_index'] + 1}/{upload['total_chunks']} uploaded successfully",
+                          'upload_id': upload['upload_id'], 'received_chunks': upload['received_chunks']})
 
 
 @views_bp.route('/upload_single_pdf_chunked', methods=['POST'])
 async def upload_single_pdf_chunked(request):
-    user_id = request.cookies.get('user_id')
-    project_id = request.form.get('project_id')
-    client_id = request.form.get('client_id')
+    user_id = get_user_id(request)
+    project_id = to_int(request.form.get('project_id'))
+    client_id = to_int(request.form.get('client_id'))
     if not user_id or not project_id:
         raise Forbidden("You need to log in and select a project to upload files")
+    if not client_id:
+        return response.json({'error': 'Invalid client'}, status=400)
 
-    chunk_index = int(request.form.get('chunk_index'))
-    total_chunks = int(request.form.get('total_chunks'))
-    file_name = secure_filename(request.form.get('file_name'))
-    chunk = request.files.get('chunk')
+    error, upload = await receive_chunk(request, [user_id, client_id, project_id])
+    if error:
+        return error
 
-    # Save chunk to a temporary file
-    temp_dir = os.path.join('uploads', str(user_id), str(client_id), str(project_id))   
-    os.makedirs(temp_dir, exist_ok=True)
-    
-    chunk_temp_dir = os.path.join('uploads', str(user_id), str(client_id), str(project_id), 'temp')
-    os.makedirs(chunk_temp_dir, exist_ok=True)
-    
-    temp_file_path = os.path.join(chunk_temp_dir, f'{file_name}.part{chunk_index}')
-    with open(temp_file_path, 'wb') as f:
-        f.write(chunk.body)
-
-    # Combine chunks if all have been uploaded
-    if chunk_index + 1 == total_chunks:
-        final_file_path = os.path.join('uploads', str(user_id), str(client_id), str(project_id), file_name)
-        os.makedirs(os.path.dirname(final_file_path), exist_ok=True)
-        with open(final_file_path, 'wb') as final_file:
-            for i in range(total_chunks):
-                part_file_path = os.path.join(chunk_temp_dir, f'{file_name}.part{i}')
-                with open(part_file_path, 'rb') as part_file:
-                    final_file.write(part_file.read())
-                os.remove(part_file_path)  # Remove part after merging
-            os.rmdir(chunk_temp_dir)  # Remove temp directory after merging
-            
-        # Generate a unique UUID folder and move this file into it.
-        unique_id = str(uuid.uuid4())
-        unique_dir = os.path.join(os.path.dirname(final_file_path), str(uuid.uuid4()) )
-        os.makedirs(unique_dir, exist_ok=True)
-        shutil.move(final_file_path, unique_dir)
-        
-        # Get the final unique file path
-        final_file_path = os.path.join(unique_dir, file_name)
+    # Once every chunk has landed the file is already assembled in place
+    if upload['completed']:
+        file_id = await register_uploaded_file(project_id, upload, get_auto_ocr_option(request))
+        if file_id is None:
+            return response.json({'error': 'Project not found'}, status=404)
+        return response.json({'message': 'File uploaded successfully', 'file_id': file_id,
+                              'upload_id': upload['upload_id'], 'ocr_started': get_auto_ocr_option(request) is not None})
 
-        # Add the file to the database within a session
-        with session_scope() as session:
-            project = session.query(Project).filter_by(id=project_id).first()
-            if not project:
-                return response.json({'error': 'Project not found'}, status=404)
+    return response.json({'message': 'Chunk uploaded successfully', 'upload_id': upload['upload_id'],
+                          'received_chunks': upload['received_chunks']})
 
-            file_entry = File(
-                uuid=unique_id,
-                project_id=project_id,
-                file_name=file_name,
-                file_size=os.path.getsize(final_file_path),
-                file_path=final_file_path,
-                status='Not processed'
-            )
-            session.add(file_entry)
-            session.commit()
-
-            # Access the file ID before closing the session
-            file_id = file_entry.id
 
-        return response.json({'message': 'File uploaded successfully', 'file_id': file_id})
+@views_bp.route('/upload_status/<upload_id>', methods=['GET'])
+async def upload_status(request, upload_id):
+    """Report which chunks of an upload have been received so the client can resume it."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to check an upload'}, status=403)
 
-    return response.json({'message': 'Chunk uploaded successfully'})
+    upload_id = parse_upload_id(upload_id)
+    status = await get_upload_status(upload_id) if upload_id else None
+    if status is None:
+        return response.json({'error': 'Upload not found'}, status=404)
+    return response.json(status)
 
 
 @views_bp.route('/get_clients', methods=['GET'])
 async def get_clients(request):
-    with session_scope() as session:
-        clients = session.query(Client).all()
+    async with async_session_scope() as session:
+        result = await session.execute(select(Client))
+        clients = result.scalars().all()
         client_list = [{"id": client.id, "name": client.name} for client in clients]
         return response.json(client_list)
 
 @views_bp.route('/get_projects/<client_id>', methods=['GET'])
 async def get_projects(request, client_id):
-    with session_scope() as session:
-        projects = session.query(Project).filter_by(client_id=client_id).all()
+    async with async_session_scope() as session:
+        result = await session.execute(select(Project).filter_by(client_id=to_int(client_id)))
+        projects = result.scalars().all()
         project_list = [{"id": project.id, "name": project.name} for project in projects]
         return response.json(project_list)
 
 
 @views_bp.route('/get_projects_by_client_name/<client_name>', methods=['GET'])
 async def get_projects_by_client_name(request, client_name):
-    with session_scope() as session:
+    async with async_session_scope() as session:
         # Normalize the client_name to handle underscores and spaces
         normalized_client_name = client_name.replace('_', ' ')  # Convert underscores back to spaces
         
         # Use case-insensitive comparison with normalized client name
-        client = session.query(Client).filter(func.lower(Client.name) == func.lower(normalized_client_name)).first()
+        result = await session.execute(
+            select(Client).filter(func.lower(Client.name) == func.lower(normalized_client_name))
+        )
+        client = result.scalars().first()
 
         if client:
-            projects = session.query(Project).filter_by(client_id=client.id).all()
+            result = await session.execute(select(Project).filter_by(client_id=client.id))
+            projects = result.scalars().all()
             project_list = [{"id": project.id, "name": project.name} for project in projects]
             return response.json(project_list)
 
         return response.json([])  # Return an empty list if no matching client found
 
 
-@views_bp.route('/start_ocr/<file_id>', methods=['POST'])
+@views_bp.route('/start_ocr/<file_id:int>', methods=['POST'])
 async def start_ocr(request, file_id):
-    ocr_option = request.json.get('ocr_option', 'basic')  # Default to 'basic' if not provided
+    ocr_option = (request.json or {}).get('ocr_option', 'basic')  # Default to 'basic' if not provided
     
-    with session_scope() as session:
-        file_entry = session.query(File).filter_by(id=file_id).first()
+    async with async_session_scope() as session:
+        file_entry = await session.get(File, file_id)
         if not file_entry:
             return response.json({'error': 'File not found'}, status=404)
 
         file_entry.status = 'Processing'
-        session.commit()
+        await session.commit()
 
         # Start the OCR process by calling ocr_pdf_file with the ocr_option
-        ocr_pdf_file.delay(file_id, ocr_option)
+        celery.send_task('app.tasks.ocr_pdf_file', args=(file_id, ocr_option))
 
     return response.json({'message': 'OCR processing started successfully'})
 
 
+@views_bp.route('/resume_ocr/<file_id:int>', methods=['POST'])
+async def resume_ocr(request, file_id):
+    """Resume a failed or stuck job, redoing only the batches without a successful checkpoint."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to resume OCR'}, status=403)
+    ocr_option = (request.json or {}).get('ocr_option', 'basic')
+
+    async with async_session_scope() as session:
+        file_entry = await session.get(File, file_id)
+        if not file_entry:
+            return response.json({'error': 'File not found'}, status=404)
+        if file_entry.status == 'Processed':
+            return response.json({'error': 'File has already been processed'}, status=400)
+
+    celery.send_task('app.tasks.resume_file_ocr', args=(file_id, ocr_option))
+    return response.json({'message': 'OCR resume queued successfully'})
+
+
+@views_bp.route('/progress/<file_id:int>', methods=['GET'])
+async def ocr_progress(request, file_id):
+    user_id = get_user_id(request)
+    if not user_id:
+        return response.json({'error': 'You must be logged in to view progress'}, status=403)
+
+    progress = await get_progress_async(file_id)
+    if progress is None:
+        return response.json({'error': 'No progress recorded for this file'}, status=404)
+    return response.json(progress)
+
+
+@views_bp.route('/progress/<file_id:int>/stream', methods=['GET'])
+async def ocr_progress_stream(request, file_id):
+    """Server-sent events stream of the job's progress until it finishes."""
+    user_id = get_user_id(request)
+    if not user_id:
+        return response.json({'error': 'You must be logged in to view progress'}, status=403)
+
+    stream = await request.respond(content_type='text/event-stream', headers={'Cache-Control': 'no-cache'})
+    last_update = None
+    while True:
+        progress = await get_progress_async(file_id)
+        if progress != last_update:
+            await stream.send(f"data: {json.dumps(progress)}\n\n")
+            last_update = progress
+        if progress is None or progress['state'] in FINISHED_STATES:
+            break
+        await asyncio.sleep(1)
+    await stream.eof()
+
+
+@views_bp.route('/start_project_ocr/<project_id:int>', methods=['POST'])
+async def start_project_ocr(request, project_id):
+    """OCR every pending file of the project as one bulk run."""
+    user_id = get_user_id(request)
+    if not user_id:
+        return response.json({'error': 'You must be logged in to start OCR'}, status=403)
+    ocr_option = (request.json or {}).get('ocr_option', 'basic')
+
+    async with async_session_scope() as session:
+        project = await session.get(Project, project_id)
+        if not project:
+            return response.json({'error': 'Project not found'}, status=404)
+
+    celery.send_task('app.tasks.ocr_pdf_folder', args=(None, project_id, ocr_option))
+    return response.json({'message': 'Project OCR started successfully'})
+
+
+@views_bp.route('/project_ocr_status/<project_id:int>', methods=['GET'])
+async def project_ocr_status(request, project_id):
+    """Aggregated status of the project's latest bulk OCR run."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to view OCR status'}, status=403)
+
+    status = await get_project_run_status_async(project_id)
+    if status is None:
+        return response.json({'error': 'No bulk OCR run found for this project'}, status=404)
+    return response.json(status)
+
+
+@views_bp.route('/queue_stats', methods=['GET'])
+async def queue_stats(request):
+    """Queue depth and recent wait times for the interactive and bulk OCR queues."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to view queue stats'}, status=403)
+    return response.json(await get_queue_stats_async())
+
+
+@views_bp.route('/metrics', methods=['GET'])
+async def metrics(request):
+    """Per-stage pipeline metrics and queue depths in the Prometheus text format, for scraping."""
+    text = await get_metrics_text_async(await get_queue_stats_async())
+    return response.text(text, content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@views_bp.route('/timing/<file_id:int>', methods=['GET'])
+async def job_timing(request, file_id):
+    """The job's per-stage spans and totals, including batch queue wait against execution time."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to view job timing'}, status=403)
+    timing = await get_job_timing_async(file_id)
+    if timing is None:
+        return response.json({'error': 'No timing recorded for this file'}, status=404)
+    return response.json(timing)
+
+
 @views_bp.route('/upload_bulk_pdf', methods=['POST'])
 async def upload_bulk_pdf(request):
-    user_id = request.cookies.get('user_id')
-    project_id = request.form.get('project_id')
+    user_id = get_user_id(request)
+    project_id = to_int(request.form.get('project_id'))
     if not user_id or not project_id:
         raise Forbidden("You need to log in and select a project to upload files")
 
@@ -311,8 +549,8 @@ async def upload_bulk_pdf(request):
 
     files = request.files.getlist('files')
 
-    with session_scope() as session:
-        project = session.query(Project).filter_by(id=project_id).first()
+    async with async_session_scope() as session:
+        project = await session.get(Project, project_id)
         if not project:
             return response.json({'error': 'Project not found'}, status=404)
 
@@ -340,45 +578,139 @@ async def upload_bulk_pdf(request):
             )
             session.add(file_entry)
 
-        session.commit()
+        await session.commit()
 
     return response.json({'message': 'Files uploaded successfully'})
 
 
+def output_file_path(file_entry):
+    """Path and download name of the file's OCR'ed output."""
+    base_name, ext = os.path.splitext(file_entry.file_name)
+    ocr_filename = f"{base_name}_OCRed_with_bookmarks{ext}"
+    return os.path.join(os.path.dirname(file_entry.file_path), ocr_filename), ocr_filename
+
+
+async def find_output_file(file_id):
+    """Return (path, download name) of the file's output, or (None, error response)."""
+    async with async_session_scope() as session:
+        file_entry = await session.get(File, file_id)
+        if not file_entry:
+            return None, response.json({'error': 'File not found'}, status=404)
+        if file_entry.status != 'Processed':
+            # A failed or re-running job may have left an older or partial output behind
+            return None, response.json({'error': 'File has not been processed'}, status=409)
+        file_path, ocr_filename = output_file_path(file_entry)
+
+    if not os.path.exists(file_path):
+        return None, response.json({'error': 'OCRed file not found on server'}, status=404)
+    return file_path, ocr_filename
+
+
 @views_bp.route('/download/<file_id:int>', methods=['GET'])
 async def download_file(request, file_id):
-    with session_scope() as session:
-        file_entry = session.query(File).filter_by(id=file_id).first()
-        if not file_entry:
-            return response.json({'error': 'File not found'}, status=404)
+    file_path, ocr_filename = await find_output_file(file_id)
+    if file_path is None:
+        return ocr_filename  # the error response
+
+    # Resumable (Range) and conditional download, or a hand-off to the front proxy
+    return await serve_file(request, file_path, ocr_filename)
+
+
+MAX_SEARCH_RESULTS = 100
+
+
+@views_bp.route('/search/<project_id:int>', methods=['GET'])
+async def search_project(request, project_id):
+    """
+    Full-text search over the OCR'ed pages of a project. ?q= takes web-search
+    syntax ("quoted phrases", or, -excluded); hits are file/page pairs ranked by
+    relevance with a highlighted snippet. Page through with ?limit= and ?offset=.
+    """
+    user_id = get_user_id(request)
+    if not user_id:
+        return response.json({'error': 'You must be logged in to search'}, status=403)
+    search_terms = (request.args.get('q') or '').strip()
+    if not search_terms:
+        return response.json({'error': 'No search terms provided'}, status=400)
+    limit = min(to_int(request.args.get('limit')) or 20, MAX_SEARCH_RESULTS)
+    offset = max(to_int(request.args.get('offset')) or 0, 0)
+
+    async with async_session_scope() as session:
+        project = await session.get(Project, project_id)
+        if not project or project.user_id != user_id:
+            return response.json({'error': 'Project not found'}, status=404)
 
-        # Construct the OCR'ed filename
-        original_filename = file_entry.file_name
-        base_name, ext = os.path.splitext(original_filename)
-        ocr_filename = f"{base_name}_OCRed_with_bookmarks{ext}"
-        file_path = os.path.join(os.path.dirname(file_entry.file_path), ocr_filename)
-
-        if not os.path.exists(file_path):
-            return response.json({'error': 'OCRed file not found on server'}, status=404)
-
-        # Get file statistics for the Content-Length header
-        file_stat = await async_os.stat(file_path)
-        headers = {
-            'Content-Disposition': f'attachment; filename="{ocr_filename}"',
-            'Content-Type': 'application/pdf',
-            'Content-Length': str(file_stat.st_size),
-        }
-
-        # Stream the file to the user
-        return await response.file_stream(
-            file_path,
-            chunk_size=8192,  # You can adjust the chunk size if needed
-            headers=headers,
+        query = func.websearch_to_tsquery(TEXT_SEARCH_CONFIG, search_terms)
+        rank = func.ts_rank_cd(PageText.search_vector, query)
+        result = await session.execute(
+            select(
+                PageText.file_id,
+                File.file_name,
+                PageText.page_number,
+                rank.label('rank'),
+                func.ts_headline(TEXT_SEARCH_CONFIG, PageText.content, query,
+                                 'MaxFragments=2, MaxWords=25, MinWords=8').label('snippet'),
+            )
+            .join(File, File.id == PageText.file_id)
+            .where(File.project_id == project_id, PageText.search_vector.op('@@')(query))
+            .order_by(rank.desc(), PageText.file_id, PageText.page_number)
+            .limit(limit)
+            .offset(offset)
         )
+        hits = [
+            {
+                "file_id": row.file_id,
+                "file_name": row.file_name,
+                "page": row.page_number,
+                "rank": round(float(row.rank), 6),
+                "snippet": row.snippet,
+                "preview_url": f"/preview/{row.file_id}/{row.page_number}",
+            }
+            for row in result
+        ]
+    return response.json({"project_id": project_id, "query": search_terms, "limit": limit,
+                          "offset": offset, "hits": hits})
+
+
+@views_bp.route('/preview/<file_id:int>/<page:int>', methods=['GET'])
+async def preview_page(request, file_id, page):
+    """One page of the OCR'ed output as a PNG, at ?dpi= (clamped, default 96)."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to preview files'}, status=403)
+    file_path, error = await find_output_file(file_id)
+    if file_path is None:
+        return error
+
+    dpi = clamp_dpi(to_int(request.args.get('dpi')))
+    image = await get_page_image(file_path, page, dpi)
+    if image is None:
+        return response.json({'error': 'Page not found'}, status=404)
+    return response.raw(image, content_type='image/png', headers={'Cache-Control': 'private, max-age=300'})
+
+
+@views_bp.route('/text/<file_id:int>', methods=['GET'])
+async def page_text(request, file_id):
+    """OCR text of pages ?start=..?end= (1-indexed, inclusive) of the output."""
+    if not get_user_id(request):
+        return response.json({'error': 'You must be logged in to read file text'}, status=403)
+    file_path, error = await find_output_file(file_id)
+    if file_path is None:
+        return error
+
+    start_page = to_int(request.args.get('start')) or 1
+    end_page = to_int(request.args.get('end')) or start_page
+    if start_page < 1 or end_page < start_page:
+        return response.json({'error': 'Invalid page range'}, status=400)
+    text = await get_page_text(file_path, start_page, end_page)
+    return response.json({"file_id": file_id, **text})
 
 
 @views_bp.route('/logout', methods=['POST'])
 async def logout(request):
+    user_id = get_user_id(request)
+    if user_id:
+        await invalidate_user(user_id)
+    request.ctx.session.clear()
     resp = response.redirect('/login')
     resp.cookies.delete_cookie('user_id')
     return resp
@@ -393,34 +725,32 @@ async def delete_projects(request):
         return response.json({'error': 'No project IDs provided'}, status=400)
 
     # Open a session and start a transaction
-    with session_scope() as session:
+    project_ids = [to_int(project_id) for project_id in project_ids]
+
+    async with async_session_scope() as session:
         try:
-            # Query and delete associated files and documents first
-            files_query = session.query(File).filter(File.project_id.in_(project_ids)).all()
-            documents_query = session.query(File).filter(File.project_id.in_(project_ids)).all()
+            # Query and delete associated files first
+            result = await session.execute(select(File).filter(File.project_id.in_(project_ids)))
+            files_query = result.scalars().all()
 
             # Delete associated files
             for file in files_query:
                 # Make sure the file path exists before trying to remove
                 if os.path.exists(file.file_path):
                     os.remove(file.file_path)
-                session.delete(file)
-
-            # Delete associated documents
-            for document in documents_query:
-                session.delete(document)
+                await session.delete(file)
 
             # Now delete the projects themselves
-            projects_query = session.query(Project).filter(Project.id.in_(project_ids)).all()
-            for project in projects_query:
-                session.delete(project)
+            result = await session.execute(select(Project).filter(Project.id.in_(project_ids)))
+            for project in result.scalars().all():
+                await session.delete(project)
 
             # Commit the transaction
-            session.commit()
+            await session.commit()
 
             return response.json({'message': 'Projects and associated data deleted successfully'}, status=200)
         except Exception as e:
             # Rollback transaction on error
-            session.rollback()
+            await session.rollback()
             print(f"Error deleting projects: {e}")
             return response.json({'error': 'Failed to delete projects'}, status=500)
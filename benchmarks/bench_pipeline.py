@@ -0,0 +1,302 @@
+"""
+Benchmark the OCR pipeline stage by stage on a synthetic scanned corpus.
+
+Each case generates an image-only PDF with the requested page count, DPI and
+bookmark depth, then runs extract_bookmarks, burst_pdf, the OCR batches (as
+Celery tasks in eager mode) and the final merge. Every stage runs in a freshly
+spawned process so its peak RSS is its own. Each case gets an empty OCR page
+cache under its work directory, so results never depend on earlier runs;
+--cache-dir shares one cache across cases (and runs) to measure warm hits.
+The report is JSON and carries the commit and settings so runs can be
+compared across commits.
+
+Usage (from the repository root, with the worker's dependencies installed):
+
+    python benchmarks/bench_pipeline.py --pages 10,100 --dpi 200,300 --depth 1,3 --output bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import importlib
+import platform
+import resource
+import threading
+import subprocess
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+# Bump whenever the report layout changes so old and new reports are not compared blindly
+REPORT_SCHEMA_VERSION = 3
+
+# Settings that change pipeline behaviour, recorded with every report
+SETTINGS_ENV = [
+    'CELERY_WORKER_CONCURRENCY', 'OCR_MAX_BATCH_COST', 'OCR_MIN_BATCH_PAGES', 'OCR_MIN_BATCH_COST_FRACTION',
+    'OCR_BURST_MODE', 'OCR_RASTER_BACKEND', 'OCR_TESSERACT_POOL_SIZE', 'OCR_CACHE_ENABLED',
+    'OCR_MIN_TEXT_CHARS', 'OCR_MIXED_IMAGE_COVERAGE',
+]
+
+
+def generate_scanned_pdf(path, pages, dpi, bookmark_depth):
+    """
+    Write an image-only PDF that looks like a scan: each page is text rendered
+    to a grayscale bitmap at the given DPI, with a bookmark tree of the given depth.
+    """
+    import fitz
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    output = fitz.open()
+    toc = []
+    for page_number in range(pages):
+        source = fitz.open()
+        page = source.new_page(width=612, height=792)
+        lines = [f"Exhibit {page_number + 1} - line {line + 1}: the quick brown fox jumps over the lazy dog"
+                 for line in range(40)]
+        page.insert_text((54, 72), "\n".join(lines), fontsize=10)
+        pixmap = page.get_pixmap(dpi=dpi, colorspace=fitz.csGRAY)
+        source.close()
+
+        scanned = output.new_page(width=612, height=792)
+        scanned.insert_image(scanned.rect, stream=pixmap.tobytes("png"))
+
+        # One bookmark per page, nesting down to bookmark_depth levels and back up
+        level = (page_number % bookmark_depth) + 1 if bookmark_depth else 0
+        if level:
+            toc.append([level, f"Bookmark {page_number + 1}", page_number + 1])
+
+    output.set_toc(toc)
+    output.save(path, garbage=3, deflate=True)
+    output.close()
+
+
+def directory_size(path):
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+class DiskSampler(threading.Thread):
+    """Sample the size of the work directory to find a stage's peak temp-disk usage."""
+
+    def __init__(self, path, interval=0.2):
+        super().__init__(daemon=True)
+        self.path = path
+        self.interval = interval
+        self.peak = directory_size(path)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.peak = max(self.peak, directory_size(self.path))
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+        self.peak = max(self.peak, directory_size(self.path))
+        return self.peak
+
+
+def stage_extract_bookmarks(pdf_path):
+    from app.utils import extract_bookmarks
+    return extract_bookmarks(pdf_path)
+
+
+def stage_burst(pdf_path):
+    from app.utils import burst_pdf
+    return burst_pdf(pdf_path)
+
+
+def stage_ocr(batch_files, batch_plan, ocr_option):
+    from celery import group
+    from app.tasks import celery, ocr_pdf_page_batch
+
+    celery.conf.task_always_eager = True
+    celery.conf.task_eager_propagates = True
+    page_range = batch_plan['mode'] == 'ranges'
+    tasks = [
+        ocr_pdf_page_batch.s(0, batch_file, start_page, end_page, ocr_option, page_range)
+        for start_page, end_page, batch_file in batch_files
+    ]
+    return group(tasks).apply().get()
+
+
+def stage_merge(results, bookmarks_list, output_dir, file_name):
+    from app.utils import merge_pdf_with_bookmarks
+    ocr_files = [res['ocr_file'] for res in sorted(results, key=lambda x: x['start_page']) if 'ocr_file' in res]
+    return merge_pdf_with_bookmarks(ocr_files, bookmarks_list, output_dir, file_name)
+
+
+STAGES = {
+    'extract_bookmarks': stage_extract_bookmarks,
+    'burst_pdf': stage_burst,
+    'ocr_batches': stage_ocr,
+    'merge_with_bookmarks': stage_merge,
+}
+# Modules each stage needs, imported before its clock starts so fitz, pikepdf,
+# Celery and SQLAlchemy start-up is not billed to the pipeline
+STAGE_IMPORTS = {
+    'extract_bookmarks': ['app.utils'],
+    'burst_pdf': ['app.utils'],
+    'ocr_batches': ['celery', 'app.tasks'],
+    'merge_with_bookmarks': ['app.utils'],
+}
+
+
+def run_stage(stage, work_dir, args):
+    """Run one stage in this (fresh) process and measure it."""
+    function = STAGES[stage]
+    import_started = time.perf_counter()
+    for module in STAGE_IMPORTS[stage]:
+        importlib.import_module(module)
+    import_s = time.perf_counter() - import_started
+    baseline_rss_kb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sampler = DiskSampler(work_dir)
+    sampler.start()
+    self_before = resource.getrusage(resource.RUSAGE_SELF)
+    children_before = resource.getrusage(resource.RUSAGE_CHILDREN)
+    started = time.perf_counter()
+
+    result = function(*args)
+
+    wall = time.perf_counter() - started
+    self_after = resource.getrusage(resource.RUSAGE_SELF)
+    children_after = resource.getrusage(resource.RUSAGE_CHILDREN)
+    peak_temp_bytes = sampler.stop()
+
+    metrics = {
+        "wall_s": round(wall, 4),
+        "import_s": round(import_s, 4),
+        "cpu_s": round((self_after.ru_utime + self_after.ru_stime) - (self_before.ru_utime + self_before.ru_stime), 4),
+        "children_cpu_s": round((children_after.ru_utime + children_after.ru_stime)
+                                - (children_before.ru_utime + children_before.ru_stime), 4),
+        "baseline_rss_kb": baseline_rss_kb,
+        "peak_rss_kb": self_after.ru_maxrss,
+        "children_peak_rss_kb": children_after.ru_maxrss,
+        "bytes_read": (self_after.ru_inblock - self_before.ru_inblock) * 512,
+        "bytes_written": (self_after.ru_oublock - self_before.ru_oublock) * 512,
+        "peak_temp_bytes": peak_temp_bytes,
+    }
+    return result, metrics
+
+
+def run_stage_isolated(stage, work_dir, *args):
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as executor:
+        return executor.submit(run_stage, stage, work_dir, args).result()
+
+
+def run_case(work_root, pages, dpi, depth, ocr_option, skip_ocr, cache_dir=None):
+    name = f"p{pages}_dpi{dpi}_depth{depth}"
+    work_dir = os.path.join(work_root, name)
+    shutil.rmtree(work_dir, ignore_errors=True)
+    # Stage processes are spawned, so they read the page cache and the upload/output roots
+    # from this environment; batch outputs stay inside the case's work dir
+    os.environ['OCR_CACHE_DIR'] = os.path.abspath(cache_dir or os.path.join(work_dir, 'ocr_cache'))
+    os.environ['OCR_UPLOAD_ROOT'] = os.path.abspath(os.path.join(work_dir, 'uploads'))
+    os.environ['OCR_OUTPUT_ROOT'] = os.path.abspath(os.path.join(work_dir, 'ocr_output'))
+    file_name = f"{name}.pdf"
+    pdf_path = os.path.join(work_dir, 'uploads', name, file_name)
+
+    started = time.perf_counter()
+    generate_scanned_pdf(pdf_path, pages, dpi, depth)
+    case = {
+        "name": name,
+        "pages": pages,
+        "dpi": dpi,
+        "bookmark_depth": depth,
+        "ocr_option": ocr_option,
+        "ocr_cache_dir": os.environ['OCR_CACHE_DIR'],
+        "input_bytes": os.path.getsize(pdf_path),
+        "generate_s": round(time.perf_counter() - started, 4),
+        "stages": {},
+    }
+
+    bookmarks_list, case["stages"]["extract_bookmarks"] = run_stage_isolated('extract_bookmarks', work_dir, pdf_path)
+    (batch_files, batch_plan), case["stages"]["burst_pdf"] = run_stage_isolated('burst_pdf', work_dir, pdf_path)
+    case["batch_count"] = len(batch_files)
+
+    if not skip_ocr:
+        results, case["stages"]["ocr_batches"] = run_stage_isolated(
+            'ocr_batches', work_dir, batch_files, batch_plan, ocr_option)
+        case["failed_batches"] = sum(1 for res in results if 'error' in res)
+        final_pdf_path, case["stages"]["merge_with_bookmarks"] = run_stage_isolated(
+            'merge_with_bookmarks', work_dir, results, bookmarks_list, os.path.dirname(pdf_path), file_name)
+        case["output_bytes"] = os.path.getsize(final_pdf_path)
+
+    total_wall = sum(stage["wall_s"] for stage in case["stages"].values())
+    case["total_wall_s"] = round(total_wall, 4)
+    case["pages_per_sec"] = round(pages / total_wall, 3) if total_wall else None
+    return case
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=REPO_ROOT, capture_output=True,
+                                text=True, check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=REPO_ROOT,
+                                    capture_output=True, text=True, check=True).stdout.strip())
+        return commit, dirty
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+
+
+def int_list(value):
+    return [int(item) for item in value.split(',') if item]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the OCR pipeline on a synthetic scanned corpus.")
+    parser.add_argument('--pages', type=int_list, default=[10, 100], help="Comma separated page counts")
+    parser.add_argument('--dpi', type=int_list, default=[200, 300], help="Comma separated scan resolutions")
+    parser.add_argument('--depth', type=int_list, default=[1, 3], help="Comma separated bookmark depths")
+    parser.add_argument('--ocr-option', default='basic', choices=['basic', 'advanced'])
+    parser.add_argument('--skip-ocr', action='store_true', help="Only benchmark the non-OCR stages")
+    parser.add_argument('--work-dir', default=os.path.join(REPO_ROOT, 'bench_work'))
+    parser.add_argument('--cache-dir', help="Share this OCR page cache across cases instead of a cold one per case")
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    commit, dirty = git_revision()
+    report = {
+        "schema_version": REPORT_SCHEMA_VERSION,
+        "commit": commit,
+        "dirty": dirty,
+        "started_at": time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        "host": {
+            "platform": platform.platform(),
+            "python": platform.python_version(),
+            "cpus": os.cpu_count(),
+        },
+        "settings": {name: os.getenv(name) for name in SETTINGS_ENV},
+        "ocr_cache": os.path.abspath(args.cache_dir) if args.cache_dir else "cold per case",
+        "cases": [],
+    }
+
+    for pages in args.pages:
+        for dpi in args.dpi:
+            for depth in args.depth:
+                print(f"Benchmarking {pages} pages at {dpi} DPI with bookmark depth {depth}", file=sys.stderr)
+                report["cases"].append(run_case(args.work_dir, pages, dpi, depth, args.ocr_option,
+                                                    args.skip_ocr, args.cache_dir))
+
+    shutil.rmtree(args.work_dir, ignore_errors=True)
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
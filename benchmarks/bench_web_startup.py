@@ -0,0 +1,73 @@
+"""
+Measure what one Sanic web worker costs to start: the time to import run.py
+(the app, its blueprints and everything they pull in), the worker's resident
+memory afterwards, and which OCR-side modules got loaded along the way.
+
+Each sample imports the app in a fresh interpreter, the same way a spawned
+worker does. Run it on two commits to compare them:
+
+    python benchmarks/bench_web_startup.py --runs 5 --output startup.json
+"""
+import os
+import sys
+import json
+import argparse
+import subprocess
+import statistics
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from benchmarks.bench_pipeline import git_revision
+
+# Modules the web tier has no use for; any of these showing up is a regression
+HEAVY_MODULES = ['fitz', 'pikepdf', 'pandas', 'numpy', 'PyPDF2', 'ocrmypdf', 'app.tasks', 'app.utils']
+
+PROBE = """
+import json, resource, sys, time
+started = time.perf_counter()
+import run
+import_s = time.perf_counter() - started
+print(json.dumps({
+    "import_s": import_s,
+    "rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+    "modules": len(sys.modules),
+    "heavy_loaded": [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+def sample():
+    result = subprocess.run([sys.executable, '-c', PROBE % (HEAVY_MODULES,)], cwd=REPO_ROOT,
+                            capture_output=True, text=True, check=True)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure Sanic worker import time and memory.")
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--output', help="Write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    samples = [sample() for _ in range(args.runs)]
+    commit, dirty = git_revision()
+    report = {
+        "commit": commit,
+        "dirty": dirty,
+        "runs": args.runs,
+        "import_s_median": round(statistics.median(s["import_s"] for s in samples), 4),
+        "import_s_min": round(min(s["import_s"] for s in samples), 4),
+        "rss_kb_median": statistics.median(s["rss_kb"] for s in samples),
+        "modules": samples[-1]["modules"],
+        "heavy_loaded": samples[-1]["heavy_loaded"],
+    }
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as report_file:
+            report_file.write(output)
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -6,10 +6,12 @@ from app.views import views_bp
 from config import Config
 from sanic_jinja2 import SanicJinja2
 from jinja2 import FileSystemLoader
-from sanic_session import Session, InMemorySessionInterface
+from sanic_session import Session
+from app.sessions import session_interface
 # from sanic_wtf import CSRFProtect
 
-app = Sanic(__name__)
+# A fixed name, because worker processes re-import this module under another __name__
+app = Sanic('ocr_on_demand')
 
 app.static('/static', './static')
 
@@ -26,11 +28,25 @@ jinja = SanicJinja2(app, loader=FileSystemLoader('app/templates'))
 app.ctx.jinja = jinja
 
 # Setup session middleware
-Session(app, interface=InMemorySessionInterface())  # Using in-memory session for simplicity
+# Sessions are kept in Redis so they are shared across worker processes and nodes
+Session(app, interface=session_interface(secure=os.getenv('SESSION_COOKIE_SECURE', '0') == '1'))
 
 # Register blueprints
 app.blueprint(auth_bp)
 app.blueprint(views_bp)
 
+# Launch settings. WEB_WORKERS > 1 starts that many worker processes behind one
+# listener (sessions are in Redis, so any worker can serve any request);
+# WEB_WORKERS=fast uses one per CPU. The access log costs a log line per
+# request; WEB_ACCESS_LOG=0 turns it off.
+WEB_HOST = os.getenv('WEB_HOST', '0.0.0.0')
+WEB_PORT = int(os.getenv('WEB_PORT', '8778'))
+WEB_WORKERS = os.getenv('WEB_WORKERS', '1')
+WEB_ACCESS_LOG = os.getenv('WEB_ACCESS_LOG', '1') == '1'
+
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8778)
+    if WEB_WORKERS == 'fast':
+        app.run(host=WEB_HOST, port=WEB_PORT, fast=True, access_log=WEB_ACCESS_LOG)
+    else:
+        app.run(host=WEB_HOST, port=WEB_PORT, workers=int(WEB_WORKERS), access_log=WEB_ACCESS_LOG)
+